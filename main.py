@@ -1,106 +1,3799 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
 import datetime
+import email.utils
+import fcntl
+import functools
+import gzip
 import hashlib
+import heapq
+import html
+import http.client
 import http.server
+import io
+import itertools
 import json
 import logging
 import mimetypes
+import os
 import pathlib
+import queue
 import re
+import secrets
+import select
+import shutil
 import signal
+import socket
 import socketserver
+import sqlite3
+import stat
+import struct
 import subprocess
+import tempfile
 import threading
+import time
 import typing
 import urllib.parse
+import zlib
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-def gen_thumbnail(input_file: str, output_file: str):
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
-    logger = logging.getLogger('[gen_thumbnail]')
+# The event types recorded by the cameras, one directory per date each.
+EVENT_TYPES = (
+    'face-detection',
+    'smart-motion-detection',
+    'tampering-detection',
+)
+
+# Event files are named after the time of day of the event.
+EVENT_FILE_REGEX = re.compile(r'(\d+)-(\d+)-(\d+)-')
+
+
+def thumbnail_command(
+    input_file: str,
+    output_file: str,
+    width: typing.Optional[int] = None,
+) -> list[str]:
+
+    # Seek into videos, images have a single frame.
+    if input_file.endswith('.mp4'):
+        command = ['ffmpeg', '-ss', '5.0', '-i', input_file, '-ss', '0']
+    else:
+        command = ['ffmpeg', '-i', input_file]
+    command += ['-vframes', '1']
+
+    # Scale down to the width, keeping the aspect ratio.
+    if width is not None:
+        command += ['-vf', f"scale='min({width},iw)':-2"]
+
+    # Encode in the format named by the extension.
+    if output_file.endswith('.avif'):
+        command += ['-c:v', 'libaom-av1', '-crf', '35', '-cpu-used', '6']
+    elif output_file.endswith('.webp'):
+        command += ['-c:v', 'libwebp', '-quality', '80']
+    else:
+        command += ['-q:v', '2']
 
     # The FFmpeg command.
-    command = [
-        'ffmpeg', '-ss', '5.0', '-i', input_file, '-ss', '0', '-vframes', '1',
-        '-q:v', '2', output_file
+    return command + [output_file]
+
+
+def list_ffmpeg(kind: str) -> set[str]:
+
+    # Ask FFmpeg which encoders, muxers, etc. it was built with.
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-hide_banner', f'-{kind}'],
+            stderr=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.DEVNULL,
+            timeout=10,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return set()
+
+    # Collect the names, which come after the capability flags.
+    names = set()
+    for line in result.stdout.decode('utf-8', errors='replace').splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            names.add(fields[1])
+    return names
+
+
+def list_thumbnail_formats() -> tuple[str, ...]:
+
+    # The formats FFmpeg can write besides JPEG, most compact first.
+    encoders = list_ffmpeg('encoders')
+    muxers = list_ffmpeg('muxers')
+    formats = []
+    if 'libaom-av1' in encoders and 'avif' in muxers:
+        formats.append('avif')
+    if 'libwebp' in encoders and 'webp' in muxers:
+        formats.append('webp')
+    return tuple(formats)
+
+
+def resize_image(input_file: str, output_file: str, width: int):
+
+    # Scale down to the width, keeping the aspect ratio, letting the JPEG
+    # decoder skip the detail that would be thrown away.
+    with Image.open(input_file) as image:
+        size = image.size
+        if width < image.width:
+            size = (width, max(1, round(image.height * width / image.width)))
+        image.draft('RGB', size)
+        resized = image.convert('RGB').resize(size, Image.LANCZOS)
+    resized.save(output_file, 'JPEG', quality=85)
+
+
+def get_temp_file(file: str) -> str:
+
+    # A hidden sibling keeping the extension, which FFmpeg goes by.
+    head, tail = os.path.split(file)
+    return os.path.join(head, f'.{secrets.token_hex(4)}.{tail}')
+
+
+def remove_file(file: str):
+
+    # Remove the file if it exists.
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(file)
+
+
+def low_priority_command(command: list[str]) -> list[str]:
+
+    # Run the command at idle I/O and lowest CPU priority, where available.
+    prefix = []
+    if shutil.which('ionice') is not None:
+        prefix += ['ionice', '-c', '3']
+    if shutil.which('nice') is not None:
+        prefix += ['nice', '-n', '19']
+    return prefix + command
+
+
+def gen_thumbnail(
+    input_file: str,
+    output_file: str,
+    low_priority: bool = False,
+    width: typing.Optional[int] = None,
+) -> bool:
+
+    logger = logging.getLogger('[gen_thumbnail]')
+
+    # Write to a temporary file so that readers never see a partial
+    # thumbnail.
+    temp_file = get_temp_file(output_file)
+
+    # Scale images down in process when Pillow is available.
+    if (
+        width is not None and
+        Image is not None and
+        not input_file.endswith('.mp4') and
+        output_file.endswith('.jpg')
+    ):
+        try:
+            resize_image(input_file, temp_file, width)
+            os.replace(temp_file, output_file)
+        except OSError:
+            logger.exception('Failed to resize %s', input_file)
+            remove_file(temp_file)
+            return False
+        return True
+
+    # Build the FFmpeg command.
+    command = thumbnail_command(input_file, temp_file, width)
+    if low_priority:
+        command = low_priority_command(command)
+
+    # Run the FFmpeg command.
+    try:
+        result = subprocess.run(
+            command,
+            start_new_session=True,
+            stderr=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stdin=subprocess.DEVNULL,
+            timeout=30,
+        )
+
+    # Catch timeout.
+    except subprocess.TimeoutExpired:
+        logger.error('FFmpeg subprocess timed out')
+        remove_file(temp_file)
+        return False
+
+    # Check if an error occured.
+    if result.returncode != 0:
+        if result.stderr:
+            for line in result.stderr.splitlines():
+                logger.debug(line.decode('utf-8', errors='replace'))
+        logger.warning(
+            'FFmpeg subprocess exited with non-zero exit code %d',
+            result.returncode,
+        )
+        remove_file(temp_file)
+        return False
+
+    # Move the thumbnail into place.
+    try:
+        os.replace(temp_file, output_file)
+    except FileNotFoundError:
+        logger.warning('FFmpeg subprocess produced no thumbnail')
+        return False
+    return True
+
+
+async def gen_thumbnail_async(
+    input_file: str,
+    output_file: str,
+    width: typing.Optional[int] = None,
+) -> bool:
+
+    logger = logging.getLogger('[gen_thumbnail_async]')
+
+    # Scale images down with Pillow off the event loop when available.
+    if (
+        width is not None and
+        Image is not None and
+        not input_file.endswith('.mp4') and
+        output_file.endswith('.jpg')
+    ):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None,
+            functools.partial(
+                gen_thumbnail,
+                input_file,
+                output_file,
+                width=width,
+            ),
+        )
+
+    # Start the FFmpeg command, writing to a temporary file so that readers
+    # never see a partial thumbnail.
+    temp_file = get_temp_file(output_file)
+    process = await asyncio.create_subprocess_exec(
+        *thumbnail_command(input_file, temp_file, width),
+        start_new_session=True,
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stdin=subprocess.DEVNULL,
+    )
+
+    # Wait for the FFmpeg command, without blocking the event loop.
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), 30)
+
+    # Catch timeout.
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logger.error('FFmpeg subprocess timed out')
+        remove_file(temp_file)
+        return False
+
+    # Check if an error occured.
+    if process.returncode != 0:
+        if stderr:
+            for line in stderr.splitlines():
+                logger.debug(line.decode('utf-8', errors='replace'))
+        logger.warning(
+            'FFmpeg subprocess exited with non-zero exit code %d',
+            process.returncode,
+        )
+        remove_file(temp_file)
+        return False
+
+    # Move the thumbnail into place.
+    try:
+        os.replace(temp_file, output_file)
+    except FileNotFoundError:
+        logger.warning('FFmpeg subprocess produced no thumbnail')
+        return False
+    return True
+
+
+def resolve_future(future: asyncio.Future):
+
+    # Complete the future, unless its waiter gave up on it.
+    if not future.done():
+        future.set_result(None)
+
+
+class Flight:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._futures = []
+
+        # The result of the flight, for the followers to answer with: ok,
+        # busy or failed.
+        self.outcome = 'failed'
+
+    def wait(self, timeout: typing.Optional[float] = None) -> bool:
+
+        # Block the calling thread until the flight lands.
+        return self._event.wait(timeout)
+
+    async def wait_async(self, timeout: typing.Optional[float] = None) -> bool:
+
+        # Register with the flight, unless it already landed.
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self._event.is_set():
+                return True
+            self._futures.append((loop, future))
+
+        # Wait on the event loop, without holding a thread.
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def set(self, outcome: str):
+
+        # Wake up the threads and the event loops waiting on the flight.
+        with self._lock:
+            self.outcome = outcome
+            self._event.set()
+            futures, self._futures = self._futures, []
+        for loop, future in futures:
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(resolve_future, future)
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: dict[str, Flight] = {}
+
+    def begin(self, key: str) -> tuple[bool, Flight]:
+
+        # Follow the flight in progress for the key, or lead a new one.
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return False, flight
+            flight = self._flights[key] = Flight()
+            return True, flight
+
+    def end(self, key: str, outcome: str):
+
+        # Land the flight with its result, waking up its followers.
+        with self._lock:
+            flight = self._flights.pop(key)
+        flight.set(outcome)
+
+
+class ProcessLimiter:
+
+    def __init__(
+        self,
+        processes: int,
+        queue_size: int = 0,
+        slot_dir: typing.Optional[pathlib.Path] = None,
+    ):
+        self._lock = threading.Lock()
+        self._available = processes
+        self._queue_size = queue_size
+
+        # Processes sharing the budget each take a slot by locking one of as
+        # many files, which the kernel unlocks should the process die. Their
+        # waiters look for a file unlocked by another process in the
+        # background.
+        self._slots = []
+        self._held = []
+        self._poller = None
+        if slot_dir is not None:
+            self._available = 0
+            for i in range(processes):
+                self._slots.append(os.open(
+                    slot_dir.joinpath(f'slot-{i}'),
+                    os.O_RDWR | os.O_CREAT | os.O_CLOEXEC,
+                    0o600,
+                ))
+
+        # Requests wait in a bounded line, served before the unbounded line
+        # of background work.
+        self._waiters = collections.deque()
+        self._background = collections.deque()
+        self.peak_waiting = 0
+        self.started = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+
+    def _take(self) -> bool:
+
+        # Take a slot free in this process.
+        if self._available > 0:
+            self._available -= 1
+            return True
+
+        # Otherwise, lock a slot file no process holds.
+        for fd in self._slots:
+            if fd in self._held:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            self._held.append(fd)
+            return True
+        return False
+
+    def _next(self) -> collections.abc.Callable[[], None]:
+
+        # Requests come before background work.
+        if self._waiters:
+            return self._waiters.popleft()
+        return self._background.popleft()
+
+    def _poll(self):
+
+        # Hand the slot files unlocked by any process to the waiters, until
+        # none is left.
+        while True:
+            wakes = []
+            with self._lock:
+                while (self._waiters or self._background) and self._take():
+                    wakes.append(self._next())
+                done = not self._waiters and not self._background
+                if done:
+                    self._poller = None
+            for wake in wakes:
+                with contextlib.suppress(RuntimeError):
+                    wake()
+            if done:
+                return
+            time.sleep(0.02)
+
+    def _enqueue(
+        self,
+        wake: collections.abc.Callable[[], None],
+        queue: bool,
+    ) -> typing.Optional[bool]:
+
+        with self._lock:
+
+            # Take a free slot right away, unless others were in line first.
+            ahead = self._waiters if queue else (
+                self._waiters or self._background
+            )
+            if not ahead and self._take():
+                self.started += 1
+                return True
+
+            # Look for the slot files other processes unlock.
+            if self._slots and self._poller is None:
+                self._poller = threading.Thread(
+                    daemon=True,
+                    name='ProcessLimiter',
+                    target=self._poll,
+                )
+                self._poller.start()
+
+            # Background work waits in its own line.
+            if not queue:
+                self._background.append(wake)
+                return None
+
+            # Turn the request away when its line is full.
+            if len(self._waiters) >= self._queue_size:
+                self.rejected += 1
+                return False
+
+            # Wait in line for a slot.
+            self._waiters.append(wake)
+            self.peak_waiting = max(self.peak_waiting, len(self._waiters))
+            return None
+
+    def _dequeue(
+        self,
+        wake: collections.abc.Callable[[], None],
+        started: float,
+    ) -> bool:
+
+        # Leave the line, unless a slot was handed over in the meantime.
+        with self._lock:
+            self.wait_time += time.monotonic() - started
+            for waiters in (self._waiters, self._background):
+                if wake in waiters:
+                    waiters.remove(wake)
+                    self.timeouts += 1
+                    return False
+            self.started += 1
+            return True
+
+    def acquire(
+        self,
+        timeout: typing.Optional[float] = None,
+        queue: bool = True,
+    ) -> bool:
+
+        # Take a slot, or wait in line for one.
+        event = threading.Event()
+        acquired = self._enqueue(event.set, queue)
+        if acquired is not None:
+            return acquired
+
+        # Block the calling thread until a slot is handed over.
+        started = time.monotonic()
+        event.wait(timeout)
+        return self._dequeue(event.set, started)
+
+    async def acquire_async(
+        self,
+        timeout: typing.Optional[float] = None,
+    ) -> bool:
+
+        # Take a slot, or wait in line for one.
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        wake = functools.partial(
+            loop.call_soon_threadsafe,
+            resolve_future,
+            future,
+        )
+        acquired = self._enqueue(wake, True)
+        if acquired is not None:
+            return acquired
+
+        # Wait on the event loop, without holding a thread, until a slot is
+        # handed over, passing it on if the request goes away meanwhile.
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if self._dequeue(wake, started):
+                self.release()
+            raise
+        return self._dequeue(wake, started)
+
+    def release(self):
+
+        # Unlock the slot file, for the waiters of every process to compete
+        # for.
+        with self._lock:
+            if self._held:
+                fcntl.flock(self._held.pop(), fcntl.LOCK_UN)
+                return
+
+            # Otherwise, hand the slot over to the first request waiting, then
+            # to the first background work, or free it.
+            if not self._waiters and not self._background:
+                self._available += 1
+                return
+            wake = self._next()
+        with contextlib.suppress(RuntimeError):
+            wake()
+
+    def stats(self) -> dict[str, typing.Union[int, float]]:
+
+        # Take a consistent snapshot of the counters.
+        with self._lock:
+            return {
+                'waiting': len(self._waiters) + len(self._background),
+                'peak_waiting': self.peak_waiting,
+                'started': self.started,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'wait_time': self.wait_time,
+            }
+
+
+def get_thumbnail_path(
+    thumbnail_dir: pathlib.Path,
+    digest: str,
+    width: typing.Optional[int] = None,
+    image_format: str = 'jpg',
+) -> pathlib.Path:
+
+    # Keep the scaled down and re-encoded variants next to the full size
+    # thumbnail.
+    name = digest if width is None else f'{digest}.w{width}'
+
+    # Fan out over two levels of 256 directories named after the digest, so
+    # the location is known without touching the disk.
+    return (
+        thumbnail_dir / digest[0:2] / digest[2:4] / f'{name}.{image_format}'
+    )
+
+
+def get_thumbnail_source(
+    data_file: pathlib.Path,
+    thumbnail_dir: pathlib.Path,
+    digest: str,
+    width: typing.Optional[int] = None,
+    image_format: str = 'jpg',
+) -> pathlib.Path:
+
+    # Re-encode the JPEG thumbnail of the same width when there is one.
+    candidates = []
+    if image_format != 'jpg':
+        candidates.append(get_thumbnail_path(thumbnail_dir, digest, width))
+
+    # Scale down the full size thumbnail of a video when there is one, rather
+    # than decoding the video again.
+    if width is not None and data_file.suffix == '.mp4':
+        candidates.append(get_thumbnail_path(thumbnail_dir, digest))
+
+    # Fall back to the source file.
+    for candidate in candidates:
+        if candidate.is_file():
+            return candidate
+    return data_file
+
+
+def negotiate_thumbnail(
+    thumbnail_dir: pathlib.Path,
+    digest: str,
+    width: typing.Optional[int],
+    accept: str,
+    formats: tuple[str, ...],
+) -> list[tuple[pathlib.Path, str]]:
+
+    # Negotiate the most compact format the client accepts.
+    image_formats = [negotiate_image_format(accept, formats)]
+
+    # AVIF takes too long to encode on request, serve it once generated
+    # ahead of time and the next best format until then.
+    if image_formats[0] == 'avif':
+        formats = tuple(other for other in formats if other != 'avif')
+        image_formats.append(negotiate_image_format(accept, formats))
+
+    # Locate the candidates without touching the disk.
+    return [
+        (
+            get_thumbnail_path(thumbnail_dir, digest, width, image_format),
+            image_format,
+        )
+        for image_format in image_formats
     ]
 
-    # Run the FFmpeg command.
-    try:
-        result = subprocess.run(
-            command,
-            start_new_session=True,
-            stderr=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-            stdin=subprocess.DEVNULL,
-            timeout=30,
+
+def parse_thumbnail_width(
+    params: dict[str, list[str]],
+    widths: collections.abc.Collection[int],
+) -> typing.Optional[int]:
+
+    # Serve the full size unless a width is requested.
+    value = params.get('w', [None])[0]
+    if value is None:
+        return None
+    width = int(value)
+    if width <= 0:
+        raise ValueError(f'Invalid width: {width}')
+
+    # Serve the configured width nearest to the one requested, the larger on
+    # a tie.
+    return min(widths, key=lambda option: (abs(option - width), -option))
+
+
+def migrate_thumbnails(thumbnail_dir: pathlib.Path) -> int:
+
+    logger = logging.getLogger('[migrate_thumbnails]')
+    count = 0
+
+    # Move the thumbnails of the old adaptive partitions into place.
+    for root, _, files in os.walk(thumbnail_dir, topdown=False):
+        for name in files:
+            digest, suffix = os.path.splitext(name)
+            if suffix != '.jpg' or not re.fullmatch(r'[0-9a-f]{64}', digest):
+                continue
+            source = pathlib.Path(root, name)
+            target = get_thumbnail_path(thumbnail_dir, digest)
+            if source == target:
+                continue
+            try:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(source, target)
+                count += 1
+            except OSError:
+                logger.exception('Failed to move %s', source)
+
+        # Remove the partitions left empty.
+        if root != str(thumbnail_dir):
+            with contextlib.suppress(OSError):
+                os.rmdir(root)
+
+    return count
+
+
+def is_date(name: str) -> bool:
+
+    # Dates are named after the day they cover.
+    try:
+        datetime.datetime.strptime(name, '%Y-%m-%d')
+        return True
+    except ValueError:
+        return False
+
+
+def list_dates(data_dir: pathlib.Path) -> list[str]:
+
+    # List all valid dates in the data directory.
+    dates = [item.name for item in data_dir.iterdir() if is_date(item.name)]
+
+    # Sort the dates chronologically.
+    dates.sort()
+    return dates
+
+
+def parse_event_file(name: str) -> typing.Optional[int]:
+
+    # Event files start with the time of day of the event.
+    match = EVENT_FILE_REGEX.match(name)
+    if match is None:
+        return None
+
+    # Skip placeholder recordings.
+    if 'deadbeef' in name.lower():
+        return None
+    hh, mm, ss = map(int, match.groups())
+    return hh * 3600 + mm * 60 + ss
+
+
+def is_event_type(name: str) -> bool:
+
+    # Only these event types are recorded.
+    return name in EVENT_TYPES
+
+
+def make_event(
+    date: str,
+    seconds: int,
+    event_type: str,
+    event_file: str,
+) -> dict[str, str]:
+
+    # Describe the event as the API reports it.
+    hh, mm, ss = seconds // 3600, seconds // 60 % 60, seconds % 60
+    return {
+        'event_type': event_type,
+        'file': f'{date}/{event_type}/{event_file}',
+        'timestamp': f'{date}T{hh}:{mm}:{ss}Z'
+    }
+
+
+class EventQuery(typing.NamedTuple):
+    start: int = 0
+    end: int = 24 * 3600
+    after: typing.Optional[tuple[int, str, str]] = None
+    limit: typing.Optional[int] = None
+    event_types: typing.Optional[tuple[str, ...]] = None
+
+
+def parse_time_of_day(value: str) -> typing.Optional[int]:
+
+    # Accept HH:MM and HH:MM:SS, up to the end of the day.
+    match = re.fullmatch(r'(\d{1,2}):(\d{2})(?::(\d{2}))?', value)
+    if match is None:
+        return None
+    hh, mm, ss = (int(group or 0) for group in match.groups())
+    if mm > 59 or ss > 59:
+        return None
+    seconds = hh * 3600 + mm * 60 + ss
+    return seconds if seconds <= 24 * 3600 else None
+
+
+def parse_event_query(
+    params: dict[str, list[str]],
+    date: str,
+) -> typing.Optional[EventQuery]:
+
+    # Parse the hours, both inclusive.
+    try:
+        from_hour = int(params.get('from_hour', ['0'])[0])
+        to_hour = int(params.get('to_hour', ['23'])[0])
+        limit = params.get('limit', [None])[0]
+        limit = None if limit is None else int(limit)
+    except ValueError:
+        return None
+    if not 0 <= from_hour <= 23 or not 0 <= to_hour <= 23:
+        return None
+    if limit is not None and limit <= 0:
+        return None
+    query = EventQuery(
+        start=from_hour * 3600,
+        end=(to_hour + 1) * 3600,
+        limit=None if limit is None else min(limit, 10000),
+    )
+
+    # Parse the time window, start inclusive and end exclusive.
+    for name in ('start', 'end'):
+        value = params.get(name, [None])[0]
+        if value is None:
+            continue
+        seconds = parse_time_of_day(value)
+        if seconds is None:
+            return None
+        if name == 'start':
+            query = query._replace(start=max(query.start, seconds))
+        else:
+            query = query._replace(end=min(query.end, seconds))
+
+    # Parse the event types, sorted so equal queries compare equal.
+    event_types = params.get('type')
+    if event_types is not None:
+        if not all(is_event_type(event_type) for event_type in event_types):
+            return None
+        query = query._replace(event_types=tuple(sorted(set(event_types))))
+
+    # Parse the cursor, either a time of day or the file of the last event
+    # of the previous page.
+    after = params.get('after', [None])[0]
+    if after is None:
+        return query
+    seconds = parse_time_of_day(after)
+    if seconds is not None:
+        return query._replace(start=max(query.start, seconds + 1))
+    cursor_date, _, cursor = after.partition('/')
+    event_type, _, event_file = cursor.partition('/')
+    seconds = parse_event_file(event_file)
+    if cursor_date != date or not is_event_type(event_type) or \
+            seconds is None:
+        return None
+    return query._replace(after=(seconds, event_type, event_file))
+
+
+def query_bounds(
+    rows: list[tuple[int, str, str]],
+    query: EventQuery,
+) -> tuple[int, int]:
+
+    # Find the sorted events matching the query.
+    lo = bisect.bisect_left(rows, (query.start,))
+    if query.after is not None:
+        lo = max(lo, bisect.bisect_right(rows, query.after))
+    hi = max(lo, bisect.bisect_left(rows, (query.end,)))
+    if query.limit is not None:
+        hi = min(hi, lo + query.limit)
+    return lo, hi
+
+
+def iter_scan_events(
+    date_dir: pathlib.Path,
+    query: EventQuery = EventQuery(),
+) -> typing.Iterator[tuple[int, str, str]]:
+
+    # Only walk the requested event type directories.
+    if query.event_types is None:
+        event_types = os.listdir(date_dir)
+    else:
+        event_types = query.event_types
+
+    # List the events of each event type within the time window, sorted
+    # chronologically, then by file for a stable order.
+    listings = []
+    for event_type in event_types:
+        if is_event_type(event_type):
+            event_dir = date_dir.joinpath(event_type)
+            try:
+                event_files = os.listdir(event_dir)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            rows = []
+            for event_file in event_files:
+                seconds = parse_event_file(event_file)
+                if seconds is not None and query.start <= seconds < query.end:
+                    rows.append((seconds, event_type, event_file))
+            rows.sort()
+            listings.append(rows)
+
+    # Merge the listings in the same order.
+    return heapq.merge(*listings)
+
+
+def scan_events(
+    date_dir: pathlib.Path,
+    query: EventQuery = EventQuery(),
+) -> list[tuple[int, str, str]]:
+
+    # List all events under the date directory.
+    return list(iter_scan_events(date_dir, query))
+
+
+def filter_events(
+    rows: typing.Iterable[tuple[int, str, str]],
+    query: EventQuery,
+) -> typing.Iterator[tuple[int, str, str]]:
+
+    # Pass the sorted events matching the query through.
+    count = 0
+    for row in rows:
+        if row[0] < query.start:
+            continue
+        if query.after is not None and row <= query.after:
+            continue
+        if row[0] >= query.end:
+            break
+        if query.event_types is not None and row[1] not in query.event_types:
+            continue
+        if query.limit is not None and count >= query.limit:
+            break
+        count += 1
+        yield row
+
+
+def list_events(
+    date_dir: pathlib.Path,
+    date: str,
+    query: EventQuery = EventQuery(),
+) -> list[dict[str, str]]:
+
+    # Walk the date directory.
+    rows = scan_events(date_dir, query)
+    lo, hi = query_bounds(rows, query)
+    return [make_event(date, *row) for row in rows[lo:hi]]
+
+
+def load_dates(
+    data_dir: pathlib.Path,
+    event_index: typing.Optional['EventIndex'] = None,
+    event_watcher: typing.Optional['EventWatcher'] = None,
+) -> list[str]:
+
+    # Prefer the in-memory event table once it is populated.
+    if event_watcher is not None:
+        dates = event_watcher.dates()
+        if dates is not None:
+            return dates
+
+    # Then the event index, falling back to listing the data directory.
+    if event_index is not None:
+        try:
+            return event_index.dates()
+        except sqlite3.Error:
+            logger = logging.getLogger('[load_dates]')
+            logger.exception('Event index failed, listing the directory')
+    return list_dates(data_dir)
+
+
+def load_events(
+    date_dir: pathlib.Path,
+    date: str,
+    event_index: typing.Optional['EventIndex'] = None,
+    event_watcher: typing.Optional['EventWatcher'] = None,
+    query: EventQuery = EventQuery(),
+) -> list[dict[str, str]]:
+
+    # Prefer the in-memory event table once it knows the date.
+    if event_watcher is not None:
+        events = event_watcher.events(date, query)
+        if events is not None:
+            return events
+
+    # Then the event index, falling back to walking the date directory.
+    if event_index is not None:
+        try:
+            return event_index.events(date, query)
+        except sqlite3.Error:
+            logger = logging.getLogger('[load_events]')
+            logger.exception('Event index failed, walking the directory')
+    return list_events(date_dir, date, query)
+
+
+def iter_events(
+    date_dir: pathlib.Path,
+    date: str,
+    event_index: typing.Optional['EventIndex'] = None,
+    event_watcher: typing.Optional['EventWatcher'] = None,
+    query: EventQuery = EventQuery(),
+) -> typing.Iterator[dict[str, str]]:
+
+    # Prefer the in-memory event table once it knows the date.
+    if event_watcher is not None:
+        events = event_watcher.events(date, query)
+        if events is not None:
+            return iter(events)
+
+    # Then the event index, falling back to walking the date directory.
+    if event_index is not None:
+        try:
+            return event_index.iter_events(date, query)
+        except sqlite3.Error:
+            logger = logging.getLogger('[iter_events]')
+            logger.exception('Event index failed, walking the directory')
+    rows = filter_events(iter_scan_events(date_dir, query), query)
+    return (make_event(date, *row) for row in rows)
+
+
+def stream_json(
+    items: typing.Iterable[typing.Any],
+    batch_size: int = 256,
+) -> typing.Iterator[bytes]:
+
+    # Encode the items as a JSON array, one batch of items at a time.
+    iterator = iter(items)
+    separator = b'['
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            break
+        yield separator + json.dumps(batch).encode('utf-8')[1:-1]
+        separator = b', '
+
+    # Close the array.
+    yield b']' if separator == b', ' else b'[]'
+
+
+def encode_stream(
+    chunks: typing.Iterable[bytes],
+    coding: typing.Optional[str],
+) -> typing.Iterator[bytes]:
+
+    # Pass the chunks through as they are.
+    if coding is None:
+        yield from chunks
+        return
+
+    # Compress each chunk, flushing so the client can decode it right away.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressed
+    yield compressor.flush()
+
+
+def date_version(
+    date_dir: pathlib.Path,
+) -> typing.Optional[tuple[typing.Optional[int], ...]]:
+
+    # Stat the date directory, which changes when event types come and go.
+    try:
+        date_stat = date_dir.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not stat.S_ISDIR(date_stat.st_mode):
+        return None
+
+    # Stat each event type directory, which changes when events come and go.
+    version = [date_stat.st_mtime_ns]
+    for event_type in EVENT_TYPES:
+        try:
+            event_stat = date_dir.joinpath(event_type).stat()
+            version.append(event_stat.st_mtime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            version.append(None)
+    return tuple(version)
+
+
+def is_settled(version: tuple[typing.Optional[int], ...]) -> bool:
+
+    # A change within the same mtime tick as the scan would go unnoticed, so
+    # only trust directories left alone for a second.
+    mtimes = [mtime_ns for mtime_ns in version if mtime_ns is not None]
+    return time.time_ns() - max(mtimes, default=0) >= 1_000_000_000
+
+
+def load_result(
+    date_dir: pathlib.Path,
+    key: tuple,
+    accept_encoding: str,
+    result_cache: typing.Optional['ResultCache'],
+    build: typing.Callable[[], typing.Any],
+    event_watcher: typing.Optional['EventWatcher'] = None,
+) -> typing.Optional[tuple[bytes, typing.Optional[str]]]:
+
+    # Check the date directory and its event type directories.
+    version = date_version(date_dir)
+    if version is None:
+        return None
+
+    # Reuse the body encoded for this version of the date.
+    key = (*key, negotiate_encoding(accept_encoding))
+    if result_cache is not None:
+        entry = result_cache.get(key, version)
+        if entry is not None:
+            return entry
+
+    # Build the result and encode it in JSON format.
+    body = json.dumps(build()).encode('utf-8')
+    entry = encode_body(body, accept_encoding)
+
+    # Cache the body once the directories are settled, and once the event
+    # table, which lags behind them when polling, has seen them too.
+    if result_cache is not None and is_settled(version) and (
+        event_watcher is None or
+        event_watcher.version(date_dir.name) == version
+    ):
+        result_cache.put(key, version, entry, len(entry[0]))
+    return entry
+
+
+def load_data(
+    date_dir: pathlib.Path,
+    date: str,
+    accept_encoding: str,
+    event_index: typing.Optional['EventIndex'] = None,
+    event_watcher: typing.Optional['EventWatcher'] = None,
+    result_cache: typing.Optional['ResultCache'] = None,
+    query: EventQuery = EventQuery(),
+) -> typing.Optional[tuple[bytes, typing.Optional[str]]]:
+
+    def build() -> typing.Any:
+
+        # List the events under the date directory.
+        if query.limit is None:
+            return load_events(
+                date_dir,
+                date,
+                event_index,
+                event_watcher,
+                query,
+            )
+
+        # Fetch one more event than requested to tell whether a page
+        # follows, and point the next page after the last event of this one.
+        events = load_events(
+            date_dir,
+            date,
+            event_index,
+            event_watcher,
+            query._replace(limit=query.limit + 1),
+        )
+        cursor = None
+        if len(events) > query.limit:
+            events = events[:query.limit]
+            cursor = events[-1]['file']
+        return {'events': events, 'next': cursor}
+
+    # Encode the events, unless cached for this version of the date.
+    key = ('data', date, query)
+    return load_result(
+        date_dir,
+        key,
+        accept_encoding,
+        result_cache,
+        build,
+        event_watcher,
+    )
+
+
+def parse_date_span(
+    params: dict[str, list[str]],
+) -> typing.Optional[tuple[typing.Optional[str], typing.Optional[str]]]:
+
+    # Parse both ends of the span, inclusive and each optional.
+    first = params.get('from', [None])[0]
+    last = params.get('to', [None])[0]
+    for date in (first, last):
+        if date is not None and not is_date(date):
+            return None
+    if first is not None and last is not None and first > last:
+        return None
+    return first, last
+
+
+def parse_date_range(
+    params: dict[str, list[str]],
+    _limit: int = 31,
+) -> typing.Optional[tuple[str, str]]:
+
+    # Parse both ends of the range, inclusive.
+    first = params.get('from', [None])[0]
+    last = params.get('to', [None])[0]
+    if first is None or last is None:
+        return None
+    try:
+        first_day = datetime.datetime.strptime(first, '%Y-%m-%d')
+        last_day = datetime.datetime.strptime(last, '%Y-%m-%d')
+    except ValueError:
+        return None
+
+    # Refuse reversed and overly long ranges.
+    if not 0 <= (last_day - first_day).days < _limit:
+        return None
+    return first, last
+
+
+def summarize_events(
+    date_dir: pathlib.Path,
+) -> tuple[dict[str, int], int]:
+
+    # Count the events of each type and add up their sizes.
+    counts = dict.fromkeys(EVENT_TYPES, 0)
+    size = 0
+    for event_type in EVENT_TYPES:
+        try:
+            entries = os.scandir(date_dir.joinpath(event_type))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with entries:
+            for entry in entries:
+                if parse_event_file(entry.name) is None:
+                    continue
+                try:
+                    size += entry.stat().st_size
+                except FileNotFoundError:
+                    continue
+                counts[event_type] += 1
+    return counts, size
+
+
+def load_summary(
+    date_dir: pathlib.Path,
+    date: str,
+    version: tuple[typing.Optional[int], ...],
+    event_index: typing.Optional['EventIndex'] = None,
+    summary_cache: typing.Optional['SummaryCache'] = None,
+) -> dict[str, typing.Any]:
+
+    # Reuse the summary of this version of the date.
+    if summary_cache is not None:
+        summary = summary_cache.get(date, version)
+        if summary is not None:
+            return summary
+
+    # Prefer the event index, which records the sizes, falling back to
+    # walking the date directory.
+    counts_size = None
+    if event_index is not None:
+        try:
+            counts_size = event_index.summary(date)
+        except sqlite3.Error:
+            logger = logging.getLogger('[load_summary]')
+            logger.exception('Event index failed, walking the directory')
+    if counts_size is None:
+        counts_size = summarize_events(date_dir)
+    counts, size = counts_size
+    summary = {'date': date, 'counts': counts, 'bytes': size}
+
+    # Cache the summary once the directories are settled.
+    if summary_cache is not None and is_settled(version):
+        summary_cache.put(date, version, summary)
+    return summary
+
+
+def load_list(
+    data_dir: pathlib.Path,
+    accept_encoding: str,
+    details: bool = False,
+    event_index: typing.Optional['EventIndex'] = None,
+    event_watcher: typing.Optional['EventWatcher'] = None,
+    result_cache: typing.Optional['ResultCache'] = None,
+    summary_cache: typing.Optional['SummaryCache'] = None,
+    executor: typing.Optional[concurrent.futures.Executor] = None,
+    first: typing.Optional[str] = None,
+    last: typing.Optional[str] = None,
+) -> tuple[bytes, typing.Optional[str]]:
+
+    # The data directory changes when dates come and go, so its listing is
+    # reused until then, once the event table has seen it too.
+    data_version = (data_dir.stat().st_mtime_ns,)
+    settled = is_settled(data_version) and (
+        event_watcher is None or event_watcher.version() == data_version
+    )
+    dates = None
+    if result_cache is not None:
+        dates = result_cache.get(('dates',), data_version)
+    if dates is None:
+        dates = load_dates(data_dir, event_index, event_watcher)
+        if result_cache is not None and settled:
+            result_cache.put(('dates',), data_version, dates, 64 * len(dates))
+
+    # Keep the dates within the span, if any.
+    if first is not None or last is not None:
+        dates = [
+            date for date in dates
+            if (first is None or first <= date) and
+            (last is None or date <= last)
+        ]
+
+    # The details of each date also depend on its directories.
+    version = data_version
+    if details:
+        versions = [date_version(data_dir.joinpath(date)) for date in dates]
+        version += tuple(versions)
+
+    # Reuse the body encoded for this version of the data directory.
+    key = ('list', details, first, last, negotiate_encoding(accept_encoding))
+    if result_cache is not None:
+        entry = result_cache.get(key, version)
+        if entry is not None:
+            return entry
+
+    # Summarize each date that still exists, concurrently if possible. Only
+    # the dates that changed since last time are counted again.
+    result = dates
+    if details:
+        existing = [
+            (date, day_version) for date, day_version in zip(dates, versions)
+            if day_version is not None
+        ]
+        mapper = map if executor is None else executor.map
+        result = list(mapper(
+            load_summary,
+            [data_dir.joinpath(date) for date, _ in existing],
+            [date for date, _ in existing],
+            [day_version for _, day_version in existing],
+            itertools.repeat(event_index),
+            itertools.repeat(summary_cache),
+        ))
+
+    # Encode the list in JSON format.
+    body = json.dumps(result).encode('utf-8')
+    entry = encode_body(body, accept_encoding)
+
+    # Cache the body once all the directories are settled.
+    if result_cache is not None and settled and (
+        not details or all(
+            is_settled(day_version) for day_version in versions
+            if day_version is not None
+        )
+    ):
+        result_cache.put(key, version, entry, len(entry[0]))
+    return entry
+
+
+def load_range(
+    data_dir: pathlib.Path,
+    dates: list[str],
+    accept_encoding: str,
+    executor: concurrent.futures.Executor,
+    event_index: typing.Optional['EventIndex'] = None,
+    event_watcher: typing.Optional['EventWatcher'] = None,
+    result_cache: typing.Optional['ResultCache'] = None,
+    query: EventQuery = EventQuery(),
+) -> tuple[bytes, typing.Optional[str]]:
+
+    # Encode the events of each day concurrently, uncompressed, reusing the
+    # bodies cached for single days.
+    def load_day(date: str) -> bytes:
+        entry = load_data(
+            data_dir.joinpath(date),
+            date,
+            '',
+            event_index,
+            event_watcher,
+            result_cache,
+            query,
+        )
+        return b'' if entry is None else entry[0][1:-1]
+
+    # Days never overlap, so merging their sorted events amounts to joining
+    # the arrays in date order.
+    items = [item for item in executor.map(load_day, dates) if item]
+    body = b'[' + b', '.join(items) + b']'
+
+    # Compress the body if the client accepts it and it is worth it.
+    return encode_body(body, accept_encoding)
+
+
+def load_stats(
+    date_dir: pathlib.Path,
+    date: str,
+    resolution: str,
+    accept_encoding: str,
+    event_index: typing.Optional['EventIndex'] = None,
+    event_watcher: typing.Optional['EventWatcher'] = None,
+    result_cache: typing.Optional['ResultCache'] = None,
+) -> typing.Optional[tuple[bytes, typing.Optional[str]]]:
+
+    def build() -> typing.Any:
+
+        # Count the events of each type per hour or per minute.
+        width = 3600 if resolution == 'hour' else 60
+        counts = {
+            event_type: [0] * (24 * 3600 // width)
+            for event_type in EVENT_TYPES
+        }
+        events = load_events(date_dir, date, event_index, event_watcher)
+        for event in events:
+            event_file = event['file'].rpartition('/')[2]
+            bucket = parse_event_file(event_file) // width
+            if bucket < len(counts[event['event_type']]):
+                counts[event['event_type']][bucket] += 1
+        return {'resolution': resolution, 'counts': counts}
+
+    # Encode the counts, unless cached for this version of the date.
+    key = ('stats', date, resolution)
+    return load_result(
+        date_dir,
+        key,
+        accept_encoding,
+        result_cache,
+        build,
+        event_watcher,
+    )
+
+
+def parse_range(
+    header: str,
+    size: int,
+    _limit: int = 16,
+) -> typing.Optional[list[tuple[int, int]]]:
+
+    # Only byte ranges are supported, anything else is ignored.
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    # Parse each range specifier into an inclusive (first, last) pair.
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        match = re.fullmatch(r'(\d*)-(\d*)', spec, re.ASCII)
+        if match is None or match.group(1) == match.group(2) == '':
+            return None
+        first, last = match.groups()
+
+        # Suffix range: the final N bytes of the file.
+        if first == '':
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(0, size - length), size - 1))
+            continue
+
+        # Bounded or open-ended range.
+        first = int(first)
+        last = int(last) if last else None
+        if last is not None and last < first:
+            return None
+        if first < size:
+            last = size - 1 if last is None else min(last, size - 1)
+            ranges.append((first, last))
+
+    # Coalesce overlapping and adjacent ranges.
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+
+    # Ignore pathological requests with too many ranges.
+    if len(merged) > _limit:
+        return None
+
+    return merged
+
+
+def make_etag(file_stat: os.stat_result) -> str:
+
+    # Derive the entity tag from the inode, size and modification time.
+    tag = '"{:x}-{:x}-{:x}"'.format(
+        file_stat.st_ino,
+        file_stat.st_size,
+        file_stat.st_mtime_ns,
+    )
+
+    # A file modified within the last second may change again without its
+    # modification time moving, so it only gets a weak entity tag.
+    if time.time() - file_stat.st_mtime < 1:
+        return 'W/' + tag
+    return tag
+
+
+def etag_matches(header: str, etag: str, weak: bool = True) -> bool:
+
+    # The wildcard matches any current representation.
+    if header.strip() == '*':
+        return True
+
+    # Compare each listed entity tag.
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if weak:
+            if candidate.removeprefix('W/') == etag.removeprefix('W/'):
+                return True
+        elif not candidate.startswith('W/') and candidate == etag:
+            return True
+    return False
+
+
+def is_not_modified(
+    headers: typing.Mapping[str, str],
+    etag: str,
+    mtime: float,
+) -> bool:
+
+    # Entity tags take precedence over modification dates.
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+
+    # Compare the modification date at the resolution of HTTP dates.
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return int(mtime) <= since.timestamp()
+
+    return False
+
+
+def if_range_matches(header: str, etag: str, last_modified: str) -> bool:
+
+    # Entity tags must match strongly.
+    header = header.strip()
+    if header.startswith('"') or header.startswith('W/'):
+        return etag_matches(header, etag, weak=False)
+
+    # Dates must match exactly.
+    return header == last_modified
+
+
+def parse_qualities(header: str) -> dict[str, float]:
+
+    # Parse the quality value of each accepted item.
+    qualities = {}
+    for item in header.split(','):
+        token, *params = item.split(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[token] = quality
+    return qualities
+
+
+def negotiate_encoding(
+    header: str,
+    codings: typing.Optional[list[str]] = None,
+) -> typing.Optional[str]:
+
+    # Parse the quality value of each accepted content coding.
+    qualities = parse_qualities(header)
+
+    # Pick the best supported coding, preferring Brotli on ties.
+    if codings is None:
+        codings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best = None
+    best_quality = 0.0
+    for coding in codings:
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best = coding
+            best_quality = quality
+    return best
+
+
+def negotiate_image_format(header: str, formats: tuple[str, ...]) -> str:
+
+    # Parse the quality value of each accepted media type.
+    qualities = parse_qualities(header)
+
+    # Weigh JPEG, which every client takes, against the formats the client
+    # names explicitly, wildcards being sent regardless of support.
+    best = 'jpg'
+    best_quality = qualities.get(
+        'image/jpeg',
+        qualities.get('image/*', qualities.get('*/*', 0.0)),
+    )
+
+    # Pick the best supported format, preferring compact ones on ties.
+    for image_format in reversed(formats):
+        quality = qualities.get(f'image/{image_format}', 0.0)
+        if quality > 0.0 and quality >= best_quality:
+            best = image_format
+            best_quality = quality
+    return best
+
+
+def compress(data: bytes, coding: str, thorough: bool = False) -> bytes:
+
+    # Spend more time when the result is stored and reused.
+    if coding == 'br':
+        return brotli.compress(data, quality=11 if thorough else 5)
+    return gzip.compress(data, compresslevel=9 if thorough else 6, mtime=0)
+
+
+def encode_body(
+    body: bytes,
+    accept_encoding: str,
+) -> tuple[bytes, typing.Optional[str]]:
+
+    # Compress the body if the client accepts it and it is worth it.
+    if len(body) < 1024:
+        return body, None
+    coding = negotiate_encoding(accept_encoding)
+    if coding is None:
+        return body, None
+    return compress(body, coding), coding
+
+
+def is_compressible(content_type: str) -> bool:
+
+    # Text formats compress well, media formats are already compressed.
+    return content_type.startswith('text/') or content_type in (
+        'application/javascript',
+        'application/json',
+        'application/xml',
+        'image/svg+xml',
+    )
+
+
+def get_sidecar(
+    file: pathlib.Path,
+    file_stat: os.stat_result,
+    coding: str,
+) -> typing.Optional[pathlib.Path]:
+
+    # Reuse the sidecar if it was generated from this version of the file.
+    sidecar = file.with_name(file.name + ('.br' if coding == 'br' else '.gz'))
+    try:
+        if sidecar.stat().st_mtime_ns == file_stat.st_mtime_ns:
+            return sidecar
+    except FileNotFoundError:
+        pass
+
+    # Generate the sidecar next to the file, atomically.
+    temp = sidecar.with_name(f'.{sidecar.name}.{secrets.token_hex(4)}')
+    try:
+        temp.write_bytes(compress(file.read_bytes(), coding, thorough=True))
+        os.utime(temp, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+        os.replace(temp, sidecar)
+    except OSError:
+        temp.unlink(missing_ok=True)
+        return None
+    return sidecar
+
+
+def precompress(static_dir: pathlib.Path) -> int:
+
+    # Generate the sidecars of every compressible static asset.
+    count = 0
+    codings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    for file in static_dir.rglob('*'):
+        if file.suffix in ('.br', '.gz') or not file.is_file():
+            continue
+        content_type, _ = mimetypes.guess_type(file)
+        if content_type is None or not is_compressible(content_type):
+            continue
+        file_stat = file.stat()
+        for coding in codings:
+            if get_sidecar(file, file_stat, coding) is not None:
+                count += 1
+    return count
+
+
+class FileResponse(typing.NamedTuple):
+    status: int
+    headers: list[tuple[str, str]]
+    file: typing.Optional[pathlib.Path] = None
+    file_stat: typing.Optional[os.stat_result] = None
+    segments: list[tuple[bytes, int, int]] = []
+
+
+def prepare_file(
+    prefix: pathlib.Path,
+    suffix: str,
+    request_headers: typing.Mapping[str, str],
+    precompressed: bool = False,
+    vary: tuple[str, ...] = (),
+) -> FileResponse:
+
+    # Resolve the file.
+    path = prefix.resolve()
+    file = path.joinpath(suffix)
+
+    # Reject directory traversals.
+    if not file.is_relative_to(path):
+        return FileResponse(403, [])
+
+    # Check if file exists.
+    try:
+        file_stat = file.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        file_stat = None
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+        return FileResponse(404, [])
+
+    # Guess the content type, files already compressed, such as the
+    # sidecars themselves, being opaque bytes.
+    content_type, encoding = mimetypes.guess_type(file)
+    if encoding is not None or file.suffix in ('.br', '.gz'):
+        content_type = None
+    content_type = content_type or 'application/octet-stream'
+
+    # Serve a precompressed sidecar if the client accepts it.
+    coding = None
+    if precompressed and is_compressible(content_type):
+        coding = 'identity'
+        accept_encoding = request_headers.get('Accept-Encoding', '')
+        preferred = negotiate_encoding(accept_encoding)
+        if preferred is not None:
+            sidecar = get_sidecar(file, file_stat, preferred)
+            if sidecar is not None:
+                coding = preferred
+                file = sidecar
+                file_stat = sidecar.stat()
+
+    # Name the request headers the response depends on.
+    if coding is not None:
+        vary += ('Accept-Encoding',)
+
+    # Determine the validators of the file.
+    size = file_stat.st_size
+    etag = make_etag(file_stat)
+    last_modified = email.utils.formatdate(file_stat.st_mtime, usegmt=True)
+
+    # Answer conditional requests whose validators still match.
+    if is_not_modified(request_headers, etag, file_stat.st_mtime):
+        headers = [
+            ('Cache-Control', 'private, max-age=3600'),
+            ('ETag', etag),
+            ('Last-Modified', last_modified),
+        ]
+        if vary:
+            headers.append(('Vary', ', '.join(vary)))
+        return FileResponse(304, headers, file, file_stat)
+
+    # Parse the requested byte ranges, unless the validator is stale.
+    ranges = None
+    range_header = request_headers.get('Range')
+    if_range = request_headers.get('If-Range')
+    if range_header is not None and (
+        if_range is None or
+        if_range_matches(if_range, etag, last_modified)
+    ):
+        ranges = parse_range(range_header, size)
+
+    # Reject unsatisfiable ranges.
+    if ranges == []:
+        headers = [
+            ('Content-Length', '0'),
+            ('Content-Range', f'bytes */{size}'),
+        ]
+        return FileResponse(416, headers, file, file_stat)
+
+    # Send the whole file.
+    if ranges is None:
+        status = 200
+        length = size
+        segments = [(b'', 0, size)]
+
+    # Send a single byte range.
+    elif len(ranges) == 1:
+        first, last = ranges[0]
+        status = 206
+        length = last - first + 1
+        segments = [(b'', first, length)]
+
+    # Send multiple byte ranges, each with its part headers.
+    else:
+        boundary = secrets.token_hex(16)
+        status = 206
+        segments = []
+        for first, last in ranges:
+            part = (
+                f'\r\n--{boundary}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Range: bytes {first}-{last}/{size}\r\n'
+                '\r\n'
+            ).encode('latin-1')
+            segments.append((part, first, last - first + 1))
+        trailer = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+        segments.append((trailer, 0, 0))
+        length = sum(len(part) + count for part, _, count in segments)
+        content_type = f'multipart/byteranges; boundary={boundary}'
+
+    # Set the response headers.
+    headers = [
+        ('Accept-Ranges', 'bytes'),
+        ('Cache-Control', 'private, max-age=3600'),
+    ]
+    if coding not in (None, 'identity'):
+        headers.append(('Content-Encoding', coding))
+    headers.append(('Content-Length', str(length)))
+    if ranges is not None and len(ranges) == 1:
+        headers.append(('Content-Range', f'bytes {first}-{last}/{size}'))
+    headers.extend([
+        ('Content-Type', content_type),
+        ('ETag', etag),
+        ('Last-Modified', last_modified),
+    ])
+    if vary:
+        headers.append(('Vary', ', '.join(vary)))
+    return FileResponse(status, headers, file, file_stat, segments)
+
+
+class ApiResponse(typing.NamedTuple):
+    status: int
+    headers: list[tuple[str, str]] = []
+    body: bytes = b''
+    chunks: typing.Optional[
+        typing.Callable[[], typing.Iterable[bytes]]
+    ] = None
+
+
+def prepare_body(
+    body: bytes,
+    coding: typing.Optional[str],
+    content_type: str,
+) -> ApiResponse:
+
+    # Set the response headers.
+    headers = [('Content-Length', str(len(body)))]
+    if coding is not None:
+        headers.append(('Content-Encoding', coding))
+    headers.append(('Content-Type', content_type))
+    headers.append(('Vary', 'Accept-Encoding'))
+    return ApiResponse(200, headers, body)
+
+
+def prepare_stream(
+    make_chunks: typing.Callable[[], typing.Iterable[bytes]],
+    content_type: str,
+    accept_encoding: str,
+) -> ApiResponse:
+
+    # Compress the stream if the client accepts gzip.
+    coding = negotiate_encoding(accept_encoding, ['gzip'])
+
+    # Set the response headers, the length is unknown until the end.
+    headers = []
+    if coding is not None:
+        headers.append(('Content-Encoding', coding))
+    headers.append(('Content-Type', content_type))
+    headers.append(('Transfer-Encoding', 'chunked'))
+    headers.append(('Vary', 'Accept-Encoding'))
+
+    # Produce the chunks once the engine sends them, in the thread of its
+    # choice.
+    return ApiResponse(
+        200,
+        headers,
+        chunks=lambda: encode_stream(make_chunks(), coding),
+    )
+
+
+class FileCache:
+
+    def __init__(self, capacity: int, max_file_size: int):
+        self._capacity = capacity
+        self._max_file_size = max_file_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(
+        self,
+        file: pathlib.Path,
+        file_stat: os.stat_result,
+    ) -> typing.Optional[bytes]:
+
+        # Large files are not worth caching.
+        if file_stat.st_size > self._max_file_size:
+            return None
+
+        # Look up the file, the entry is only valid for the same version.
+        key = str(file)
+        version = (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Read the file, give up if it changed while reading.
+        with open(file, 'rb') as handle:
+            data = handle.read(file_stat.st_size + 1)
+        if len(data) != file_stat.st_size:
+            return None
+
+        # Store the file, evicting the least recently used ones.
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= len(entry[1])
+            self._entries[key] = (version, data)
+            self._size += len(data)
+            while self._size > self._capacity:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+        return data
+
+    def stats(self) -> dict[str, int]:
+
+        # Take a consistent snapshot of the counters.
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class ResultCache:
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(
+        self,
+        key: collections.abc.Hashable,
+        version: collections.abc.Hashable,
+    ) -> typing.Any:
+
+        # Look up the result, the entry is only valid for the same version.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        key: collections.abc.Hashable,
+        version: collections.abc.Hashable,
+        value: typing.Any,
+        size: int,
+    ):
+
+        # Results larger than the whole cache are not worth caching.
+        if size > self._capacity:
+            return
+
+        # Store the result, evicting the least recently used ones.
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[2]
+            self._entries[key] = (version, value, size)
+            self._size += size
+            while self._size > self._capacity:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+
+    def stats(self) -> dict[str, int]:
+
+        # Take a consistent snapshot of the counters.
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class SummaryCache:
+
+    def __init__(self):
+        self._entries: dict[str, tuple[collections.abc.Hashable, dict]] = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        date: str,
+        version: collections.abc.Hashable,
+    ) -> typing.Optional[dict[str, typing.Any]]:
+
+        # Look up the summary, the entry is only valid for the same version.
+        with self._lock:
+            entry = self._entries.get(date)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+            return None
+
+    def put(
+        self,
+        date: str,
+        version: collections.abc.Hashable,
+        summary: dict[str, typing.Any],
+    ):
+
+        # Keep one summary per date, which is small enough to never evict,
+        # unlike the response bodies of the result cache.
+        with self._lock:
+            self._entries[date] = (version, summary)
+
+
+class EventIndex:
+
+    def __init__(self, path: pathlib.Path, data_dir: pathlib.Path):
+        self._path = path
+        self._data_dir = data_dir
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        # Create the schema.
+        connection = self._connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS directories (
+                    path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS dates (
+                    date TEXT PRIMARY KEY
+                );
+                CREATE TABLE IF NOT EXISTS events (
+                    date TEXT NOT NULL,
+                    event_type TEXT NOT NULL,
+                    file TEXT NOT NULL,
+                    seconds INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    PRIMARY KEY (date, event_type, file)
+                );
+                CREATE INDEX IF NOT EXISTS events_by_time
+                    ON events (date, seconds, event_type, file);
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+
+        # SQLite connections cannot be shared between threads.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def build(self) -> int:
+
+        # Index every date of the data directory.
+        for date in self.dates():
+            self.refresh(date)
+
+        # Count the indexed events.
+        connection = self._connect()
+        return connection.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+
+    def dates(self) -> list[str]:
+
+        # List the dates again only when the data directory changed.
+        connection = self._connect()
+        mtime_ns = self._data_dir.stat().st_mtime_ns
+        row = connection.execute(
+            "SELECT mtime_ns FROM directories WHERE path = ''",
+        ).fetchone()
+        if row is None or row[0] != mtime_ns:
+            dates = list_dates(self._data_dir)
+            with self._lock, connection:
+                rows = connection.execute('SELECT date FROM dates')
+                known = {date for date, in rows}
+                for date in known.difference(dates):
+                    self._forget(connection, date)
+                connection.executemany(
+                    'INSERT OR IGNORE INTO dates (date) VALUES (?)',
+                    [(date,) for date in dates],
+                )
+                connection.execute(
+                    'INSERT OR REPLACE INTO directories VALUES (?, ?)',
+                    ('', mtime_ns),
+                )
+
+        # Query the dates in chronological order.
+        rows = connection.execute('SELECT date FROM dates ORDER BY date')
+        return [date for date, in rows]
+
+    def events(
+        self,
+        date: str,
+        query: EventQuery = EventQuery(),
+    ) -> list[dict[str, str]]:
+
+        # Fetch all the events at once.
+        return list(self.iter_events(date, query))
+
+    def iter_events(
+        self,
+        date: str,
+        query: EventQuery = EventQuery(),
+    ) -> typing.Iterator[dict[str, str]]:
+
+        # Bring the date up to date.
+        self.refresh(date)
+
+        # Query its events, resuming after the cursor if any.
+        sql = 'SELECT seconds, event_type, file FROM events ' \
+            'WHERE date = ? AND seconds >= ? AND seconds < ?'
+        params = [date, query.start, query.end]
+        if query.after is not None:
+            sql += ' AND (seconds, event_type, file) > (?, ?, ?)'
+            params.extend(query.after)
+        if query.event_types is not None:
+            placeholders = ', '.join('?' * len(query.event_types))
+            sql += f' AND event_type IN ({placeholders})'
+            params.extend(query.event_types)
+        sql += ' ORDER BY seconds, event_type, file LIMIT ?'
+        params.append(-1 if query.limit is None else query.limit)
+        rows = self._connect().execute(sql, params)
+        return (make_event(date, *row) for row in rows)
+
+    def refresh(self, date: str):
+
+        # Check the date directory.
+        connection = self._connect()
+        date_dir = self._data_dir.joinpath(date)
+        try:
+            date_mtime_ns = date_dir.stat().st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            with self._lock, connection:
+                self._forget(connection, date)
+            return
+
+        # Load the modification times recorded at the last scan.
+        known = dict(connection.execute(
+            'SELECT path, mtime_ns FROM directories '
+            'WHERE path = ? OR path LIKE ?',
+            (date, date + '/%'),
+        ))
+
+        # List the event type directories again only if some were added or
+        # removed since the last scan.
+        if known.get(date) == date_mtime_ns:
+            event_types = [
+                path.split('/', 1)[1] for path in known if '/' in path
+            ]
+        else:
+            event_types = [
+                item.name for item in date_dir.iterdir()
+                if is_event_type(item.name)
+            ]
+
+        # Find the event type directories that changed.
+        changed = {}
+        for event_type in event_types:
+            try:
+                mtime_ns = date_dir.joinpath(event_type).stat().st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                mtime_ns = None
+            if known.get(f'{date}/{event_type}') != mtime_ns:
+                changed[event_type] = mtime_ns
+        for path in known:
+            event_type = path.partition('/')[2]
+            if event_type and event_type not in event_types:
+                changed[event_type] = None
+        if not changed and known.get(date) == date_mtime_ns:
+            return
+
+        # Scan the changed event type directories, recording the modification
+        # times seen before scanning so concurrent changes trigger a rescan.
+        scanned = {}
+        for event_type, mtime_ns in changed.items():
+            rows = []
+            if mtime_ns is not None:
+                event_dir = date_dir.joinpath(event_type)
+                for item in event_dir.iterdir():
+                    seconds = parse_event_file(item.name)
+                    if seconds is None:
+                        continue
+                    try:
+                        item_stat = item.stat()
+                    except FileNotFoundError:
+                        continue
+                    rows.append((
+                        date,
+                        event_type,
+                        item.name,
+                        seconds,
+                        item_stat.st_size,
+                        item_stat.st_mtime_ns,
+                    ))
+            scanned[event_type] = (mtime_ns, rows)
+
+        # Replace the indexed events of the changed directories.
+        with self._lock, connection:
+            for event_type, (mtime_ns, rows) in scanned.items():
+                path = f'{date}/{event_type}'
+                connection.execute(
+                    'DELETE FROM events WHERE date = ? AND event_type = ?',
+                    (date, event_type),
+                )
+                connection.executemany(
+                    'INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)',
+                    rows,
+                )
+                if mtime_ns is None:
+                    connection.execute(
+                        'DELETE FROM directories WHERE path = ?',
+                        (path,),
+                    )
+                else:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO directories VALUES (?, ?)',
+                        (path, mtime_ns),
+                    )
+            connection.execute(
+                'INSERT OR REPLACE INTO directories VALUES (?, ?)',
+                (date, date_mtime_ns),
+            )
+            connection.execute(
+                'INSERT OR IGNORE INTO dates (date) VALUES (?)',
+                (date,),
+            )
+
+    def summary(self, date: str) -> tuple[dict[str, int], int]:
+
+        # Bring the date up to date, then count its events per type.
+        self.refresh(date)
+        rows = self._connect().execute(
+            'SELECT event_type, COUNT(*), SUM(size) FROM events '
+            'WHERE date = ? GROUP BY event_type',
+            (date,),
+        )
+        counts = dict.fromkeys(EVENT_TYPES, 0)
+        size = 0
+        for event_type, count, event_size in rows:
+            counts[event_type] = count
+            size += event_size
+        return counts, size
+
+    def _forget(self, connection: sqlite3.Connection, date: str):
+
+        # Drop everything recorded about the date.
+        connection.execute('DELETE FROM dates WHERE date = ?', (date,))
+        connection.execute('DELETE FROM events WHERE date = ?', (date,))
+        connection.execute(
+            'DELETE FROM directories WHERE path = ? OR path LIKE ?',
+            (date, date + '/%'),
+        )
+
+
+class EventWatcher:
+
+    # Flags of the Linux inotify API.
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self, data_dir: pathlib.Path, poll_interval: float = 1.0):
+        self._logger = logging.getLogger('[EventWatcher]')
+        self._data_dir = data_dir
+        self._poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # The event table maps each date and event type to the seconds of
+        # the day of every event file, with the sorted events of each date
+        # memoized until it changes.
+        self._table: dict[str, dict[str, dict[str, int]]] = {}
+        self._sorted: dict[str, tuple[list, list[dict[str, str]]]] = {}
+
+        # The directory modification times seen at the last scan, and those
+        # the event table reflects, per date in the shape of date_version.
+        self._mtimes: dict[str, int] = {}
+        self._versions: dict[str, tuple[typing.Optional[int], ...]] = {}
+
+        # The inotify descriptor and watched directories, if any.
+        self._libc = None
+        self._inotify = None
+        self._watches: dict[int, str] = {}
+
+    def start(self):
+
+        # Watch the data directory in the background.
+        self._thread = threading.Thread(
+            daemon=True,
+            name='EventWatcher',
+            target=self._run,
+        )
+        self._thread.start()
+
+    def stop(self):
+
+        # Wait for the watcher to notice.
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def dates(self) -> typing.Optional[list[str]]:
+
+        # Nothing is known before the first scan completes.
+        if not self._ready.is_set():
+            return None
+        with self._lock:
+            return sorted(self._table)
+
+    def version(
+        self,
+        date: str = '',
+    ) -> typing.Optional[tuple[typing.Optional[int], ...]]:
+
+        # The directory mtimes the event table of the date, or the list of
+        # dates by default, was last brought up to date with.
+        with self._lock:
+            return self._versions.get(date)
+
+    def events(
+        self,
+        date: str,
+        query: EventQuery = EventQuery(),
+    ) -> typing.Optional[list[dict[str, str]]]:
+
+        # Nothing is known before the first scan completes.
+        if not self._ready.is_set():
+            return None
+
+        # Sort the events of the date at most once per change.
+        with self._lock:
+            if date not in self._table:
+                return None
+            memo = self._sorted.get(date)
+            if memo is None:
+                rows = [
+                    (seconds, event_type, event_file)
+                    for event_type, files in self._table[date].items()
+                    for event_file, seconds in files.items()
+                ]
+                rows.sort()
+                events = [make_event(date, *row) for row in rows]
+                memo = self._sorted[date] = (rows, events)
+
+        # Slice the events matching the query.
+        rows, events = memo
+        if query == EventQuery():
+            return events
+        if query.event_types is None:
+            lo, hi = query_bounds(rows, query)
+            return events[lo:hi]
+
+        # Then pick the requested event types.
+        lo, hi = query_bounds(rows, query._replace(limit=None))
+        events = [
+            events[i] for i in range(lo, hi)
+            if rows[i][1] in query.event_types
+        ]
+        return events[:query.limit]
+
+    def _run(self):
+
+        # Prefer inotify, falling back to polling directory mtimes.
+        try:
+            self._open_inotify()
+        except OSError as error:
+            self._logger.warning('Polling the data directory: %s', error)
+            self._close_inotify()
+
+        # Scan the data directory once, watching every directory seen.
+        while not self._stop.is_set():
+            try:
+                self._sync_data()
+                break
+            except OSError:
+                self._logger.exception('Failed to scan the data directory')
+                self._stop.wait(self._poll_interval)
+        self._ready.set()
+
+        # Apply the changes as they come.
+        while not self._stop.is_set():
+            try:
+                if self._inotify is not None:
+                    self._read_inotify()
+                else:
+                    self._stop.wait(self._poll_interval)
+                    self._sync_data()
+            except OSError:
+                self._logger.exception('Failed to update the event table')
+                self._stop.wait(self._poll_interval)
+        self._close_inotify()
+
+    def _open_inotify(self):
+
+        # Load the inotify API from the C library.
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self._libc = libc
+        self._inotify = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self._inotify < 0:
+            self._inotify = None
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def _close_inotify(self):
+        if self._inotify is not None:
+            os.close(self._inotify)
+            self._inotify = None
+            self._watches.clear()
+
+    def _watch(self, path: str):
+
+        # Nothing to do when polling.
+        if self._inotify is None:
+            return
+
+        # Watch the directory for entries created, deleted or moved. The
+        # same directory always yields the same watch descriptor.
+        mask = self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_FROM | \
+            self.IN_MOVED_TO | self.IN_ONLYDIR
+        wd = self._libc.inotify_add_watch(
+            self._inotify,
+            os.fsencode(self._data_dir.joinpath(path)),
+            mask,
+        )
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self._watches[wd] = path
+
+    def _read_inotify(self):
+
+        # Wake up regularly to notice the stop event.
+        readable, _, _ = select.select([self._inotify], [], [], 1.0)
+        if not readable:
+            return
+
+        # Read the events until none are left, statting the directories
+        # changed so far before each read: every change those mtimes reflect
+        # was queued before the stat, so it is applied once the queue runs dry.
+        changed = set()
+        mtimes = {}
+        while True:
+            for path in changed:
+                try:
+                    path_stat = self._data_dir.joinpath(path).stat()
+                    mtimes[path] = path_stat.st_mtime_ns
+                except (FileNotFoundError, NotADirectoryError):
+                    mtimes[path] = None
+            try:
+                buffer = os.read(self._inotify, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            # Apply each event in turn.
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = struct.unpack_from(
+                    'iIII',
+                    buffer,
+                    offset,
+                )
+                offset += 16
+                name = buffer[offset:offset + length].rstrip(b'\0')
+                name = os.fsdecode(name)
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    self._logger.warning('Event queue overflowed, rescanning')
+                    self._mtimes.clear()
+                    self._sync_data()
+                elif mask & self.IN_IGNORED:
+                    self._watches.pop(wd, None)
+                elif wd in self._watches:
+                    changed.add(self._watches[wd])
+                    self._apply(self._watches[wd], name, mask)
+
+        # Record the mtimes of the directories still known, then the versions
+        # of the dates they belong to.
+        for path, mtime_ns in mtimes.items():
+            if path in self._mtimes and mtime_ns is not None:
+                self._mtimes[path] = mtime_ns
+        for date in {path.partition('/')[0] for path in changed}:
+            self._publish(date)
+
+    def _apply(self, path: str, name: str, mask: int):
+
+        # Which directory level changed?
+        added = bool(mask & (self.IN_CREATE | self.IN_MOVED_TO))
+        is_dir = bool(mask & self.IN_ISDIR)
+        parts = path.split('/') if path else []
+
+        # A date was added or removed.
+        if len(parts) == 0 and is_dir and is_date(name):
+            if added:
+                self._mtimes.pop(name, None)
+                self._sync_date(name)
+            else:
+                self._forget(name)
+
+        # An event type directory was added or removed.
+        elif len(parts) == 1 and is_dir and is_event_type(name):
+            if added:
+                self._mtimes.pop(f'{path}/{name}', None)
+                self._sync_type(parts[0], name)
+            else:
+                self._forget(parts[0], name)
+
+        # An event file was added or removed.
+        elif len(parts) == 2 and not is_dir:
+            seconds = parse_event_file(name)
+            if seconds is not None:
+                with self._lock:
+                    files = self._table.get(parts[0], {}).get(parts[1])
+                    if files is None:
+                        return
+                    if added:
+                        files[name] = seconds
+                    else:
+                        files.pop(name, None)
+                    self._sorted.pop(parts[0], None)
+
+    def _changed(self, path: str) -> typing.Optional[bool]:
+
+        # Compare the directory mtime with the one seen at the last scan,
+        # watching the directory before it is listed again.
+        try:
+            mtime_ns = self._data_dir.joinpath(path).stat().st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if self._mtimes.get(path) == mtime_ns:
+            return False
+        self._watch(path)
+        self._mtimes[path] = mtime_ns
+        return True
+
+    def _sync_data(self):
+
+        # List the dates again if the data directory changed.
+        if self._changed(''):
+            dates = list_dates(self._data_dir)
+            with self._lock:
+                vanished = set(self._table).difference(dates)
+            for date in vanished:
+                self._forget(date)
+        else:
+            with self._lock:
+                dates = list(self._table)
+
+        # Check every date.
+        for date in dates:
+            self._sync_date(date)
+        self._publish('')
+
+    def _sync_date(self, date: str):
+
+        # Forget the date if it vanished.
+        changed = self._changed(date)
+        if changed is None:
+            self._forget(date)
+            return
+
+        # List the event types again if the date directory changed.
+        with self._lock:
+            event_types = list(self._table.setdefault(date, {}))
+        if changed:
+            event_types = [
+                item.name for item in self._data_dir.joinpath(date).iterdir()
+                if is_event_type(item.name)
+            ]
+            with self._lock:
+                vanished = set(self._table[date]).difference(event_types)
+            for event_type in vanished:
+                self._forget(date, event_type)
+
+        # Check every event type.
+        for event_type in event_types:
+            self._sync_type(date, event_type)
+        self._publish(date)
+
+    def _sync_type(self, date: str, event_type: str):
+
+        # Forget the event type if it vanished.
+        path = f'{date}/{event_type}'
+        changed = self._changed(path)
+        if changed is None:
+            self._forget(date, event_type)
+            return
+        if not changed:
+            return
+
+        # List the events again.
+        files = {}
+        for item in self._data_dir.joinpath(path).iterdir():
+            seconds = parse_event_file(item.name)
+            if seconds is not None:
+                files[item.name] = seconds
+        with self._lock:
+            self._table.setdefault(date, {})[event_type] = files
+            self._sorted.pop(date, None)
+
+    def _publish(self, date: str):
+
+        # The table now reflects the mtimes seen at the last scan. Only
+        # publish them once the table is up to date, lest a body built from
+        # an older table be cached under the new version of the directories.
+        paths = [date]
+        if date:
+            paths += [f'{date}/{event_type}' for event_type in EVENT_TYPES]
+        version = tuple(self._mtimes.get(path) for path in paths)
+        with self._lock:
+            if version[0] is None:
+                self._versions.pop(date, None)
+            else:
+                self._versions[date] = version
+
+    def _forget(self, date: str, event_type: typing.Optional[str] = None):
+
+        # Drop the date or one of its event types.
+        with self._lock:
+            if event_type is None:
+                self._table.pop(date, None)
+            elif date in self._table:
+                self._table[date].pop(event_type, None)
+            self._sorted.pop(date, None)
+
+        # Forget the mtimes seen below.
+        prefix = date if event_type is None else f'{date}/{event_type}'
+        for path in list(self._mtimes):
+            if path == prefix or path.startswith(prefix + '/'):
+                del self._mtimes[path]
+        self._publish(date)
+
+
+class ThumbnailPregenerator:
+
+    def __init__(
+        self,
+        data_dir: pathlib.Path,
+        thumbnail_dir: pathlib.Path,
+        workers: int,
+        days: int,
+        event_index: typing.Optional[EventIndex] = None,
+        event_watcher: typing.Optional[EventWatcher] = None,
+        flights: typing.Optional[SingleFlight] = None,
+        limiter: typing.Optional[ProcessLimiter] = None,
+        widths: collections.abc.Iterable[int] = (),
+        formats: tuple[str, ...] = (),
+        interval: float = 30.0,
+    ):
+        self._logger = logging.getLogger('[ThumbnailPregenerator]')
+        self._data_dir = data_dir
+        self._thumbnail_dir = thumbnail_dir
+        self._workers = workers
+        self._days = days
+        self._widths = sorted(widths)
+        self._formats = formats
+        self._event_index = event_index
+        self._event_watcher = event_watcher
+        self._flights = flights or SingleFlight()
+        self._limiter = limiter or ProcessLimiter(workers)
+        self._interval = interval
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+
+        # The videos queued or known to have a thumbnail, by date.
+        self._lock = threading.Lock()
+        self._queued: set[str] = set()
+        self._done: dict[str, set[str]] = {}
+
+    def start(self):
+
+        # Discover new videos in the background.
+        thread = threading.Thread(
+            daemon=True,
+            name='ThumbnailPregenerator',
+            target=self._scan,
+        )
+        thread.start()
+        self._threads.append(thread)
+
+        # Generate their thumbnails on a pool of workers.
+        for i in range(self._workers):
+            thread = threading.Thread(
+                daemon=True,
+                name=f'ThumbnailPregenerator-{i}',
+                target=self._work,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+
+        # Wait for the discovery to notice, the workers are left to finish
+        # their thumbnail, which is bounded by the FFmpeg timeout.
+        self._stop.set()
+        self._threads[0].join()
+
+    def _scan(self):
+
+        # Look for videos without thumbnails until stopped.
+        while not self._stop.is_set():
+            try:
+                self._discover()
+            except OSError:
+                self._logger.exception('Failed to discover new videos')
+            self._stop.wait(self._interval)
+
+    def _discover(self):
+
+        # Only the most recent dates are worth the effort.
+        dates = load_dates(
+            self._data_dir,
+            self._event_index,
+            self._event_watcher,
+        )
+        dates = dates[-self._days:] if self._days > 0 else []
+        with self._lock:
+            for date in set(self._done).difference(dates):
+                del self._done[date]
+
+        # Queue the videos without a thumbnail, the newest first.
+        count = 0
+        for date in reversed(dates):
+            events = load_events(
+                self._data_dir.joinpath(date),
+                date,
+                self._event_index,
+                self._event_watcher,
+            )
+            for event in reversed(events):
+                file = event['file']
+                if not file.endswith('.mp4'):
+                    continue
+                with self._lock:
+                    done = self._done.setdefault(date, set())
+                    if file in done or file in self._queued:
+                        continue
+                digest = hashlib.sha256(file.encode('utf-8')).hexdigest()
+                if all(
+                    thumbnail_file.is_file()
+                    for thumbnail_file, _, _ in self._variants(digest)
+                ):
+                    with self._lock:
+                        done.add(file)
+                    continue
+                with self._lock:
+                    self._queued.add(file)
+                self._queue.put(file)
+                count += 1
+        if count > 0:
+            self._logger.info('Queued %d thumbnails', count)
+
+    def _work(self):
+
+        # Generate thumbnails until stopped.
+        while not self._stop.is_set():
+            try:
+                file = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            # Generate the thumbnails where the request handlers look for
+            # them, each variant from the one before when possible.
+            digest = hashlib.sha256(file.encode('utf-8')).hexdigest()
+            data_file = self._data_dir.joinpath(file)
+            for thumbnail_file, width, image_format in self._variants(digest):
+                try:
+                    self._generate(
+                        data_file,
+                        digest,
+                        thumbnail_file,
+                        width,
+                        image_format,
+                    )
+                except OSError:
+                    self._logger.exception('Failed to generate thumbnail')
+
+            # Consider the video done either way, a failed thumbnail is tried
+            # again on request.
+            with self._lock:
+                self._queued.discard(file)
+                date = file.partition('/')[0]
+                if date in self._done:
+                    self._done[date].add(file)
+
+    def _variants(
+        self,
+        digest: str,
+    ) -> list[tuple[pathlib.Path, typing.Optional[int], str]]:
+
+        # The full size thumbnail, then the widths the pages ask for, each
+        # also in the compact formats, the quickest to encode first.
+        variants = [(None, 'jpg')]
+        for width in self._widths:
+            variants.append((width, 'jpg'))
+            for image_format in reversed(self._formats):
+                variants.append((width, image_format))
+        return [
+            (
+                get_thumbnail_path(
+                    self._thumbnail_dir,
+                    digest,
+                    width,
+                    image_format,
+                ),
+                width,
+                image_format,
+            )
+            for width, image_format in variants
+        ]
+
+    def _generate(
+        self,
+        data_file: pathlib.Path,
+        digest: str,
+        thumbnail_file: pathlib.Path,
+        width: typing.Optional[int],
+        image_format: str,
+    ):
+
+        # Wait for a request already generating the thumbnail, so that the
+        # next variant can be derived from it.
+        key = thumbnail_file.name
+        leader, flight = self._flights.begin(key)
+        if not leader:
+            flight.wait(45)
+            return
+
+        # Generate the thumbnail, unless one appeared in the meantime.
+        outcome = 'failed'
+        try:
+            if thumbnail_file.is_file():
+                outcome = 'ok'
+                return
+            source_file = get_thumbnail_source(
+                data_file,
+                self._thumbnail_dir,
+                digest,
+                width,
+                image_format,
+            )
+            thumbnail_file.parent.mkdir(parents=True, exist_ok=True)
+            self._limiter.acquire(queue=False)
+            try:
+                if gen_thumbnail(
+                    str(source_file),
+                    str(thumbnail_file),
+                    low_priority=True,
+                    width=width,
+                ):
+                    outcome = 'ok'
+            finally:
+                self._limiter.release()
+        finally:
+            self._flights.end(key, outcome)
+
+
+class ThumbnailTarget(typing.NamedTuple):
+    status: int
+    response: typing.Optional[FileResponse] = None
+    prefix: typing.Optional[pathlib.Path] = None
+    suffix: typing.Optional[str] = None
+    vary: tuple[str, ...] = ()
+    source_file: typing.Optional[pathlib.Path] = None
+    thumbnail_file: typing.Optional[pathlib.Path] = None
+    width: typing.Optional[int] = None
+
+
+class BaseHandler:
+
+    def query_params(self) -> dict[str, list[str]]:
+
+        # Parse the query string of the request.
+        parsed = urllib.parse.urlparse(self.path)
+        return urllib.parse.parse_qs(parsed.query)
+
+    def prepare_api(self, path: str) -> ApiResponse:
+
+        # Match the requested API resource.
+        if path == '/api/calendar':
+            return self.prepare_calendar()
+        if path == '/api/data':
+            return self.prepare_data()
+        if path == '/api/list':
+            return self.prepare_list()
+        if path == '/api/stats':
+            return self.prepare_stats()
+        return ApiResponse(404)
+
+    def prepare_calendar(self) -> ApiResponse:
+
+        # Parse the span of dates, the whole archive by default.
+        span = parse_date_span(self.query_params())
+        if span is None:
+            return ApiResponse(400)
+
+        # Summarize each date within the span and encode them in JSON format,
+        # unless cached for this version of the directories.
+        first, last = span
+        body, coding = load_list(
+            self.config_data_dir.resolve(),
+            self.headers.get('Accept-Encoding', ''),
+            True,
+            self.config_event_index,
+            self.config_event_watcher,
+            self.config_result_cache,
+            self.config_summary_cache,
+            self.config_scan_executor,
+            first,
+            last,
+        )
+        return prepare_body(body, coding, 'application/json')
+
+    def prepare_data(self) -> ApiResponse:
+
+        # Parse the date, unless a range of dates is requested.
+        params = self.query_params()
+        if 'from' in params or 'to' in params:
+            return self.prepare_data_range(params)
+        date = params.get('date', [None])[0]
+        if date is None:
+            return ApiResponse(400)
+        try:
+            datetime.datetime.strptime(date, '%Y-%m-%d')
+        except ValueError:
+            return ApiResponse(400)
+
+        # Parse the hours, page size and cursor.
+        query = parse_event_query(params, date)
+        if query is None:
+            return ApiResponse(400)
+
+        # Resolve the date directory.
+        date_dir = self.config_data_dir.resolve().joinpath(date)
+
+        # Stream the events one chunk at a time if asked to, which needs
+        # HTTP/1.1 chunked transfer encoding and makes no sense for pages.
+        stream = params.get('stream', ['0'])[0] not in ('0', '')
+        if (
+            stream and
+            query.limit is None and
+            self.request_version == 'HTTP/1.1'
+        ):
+            if not date_dir.is_dir():
+                return ApiResponse(404)
+            return prepare_stream(
+                lambda: stream_json(iter_events(
+                    date_dir,
+                    date,
+                    self.config_event_index,
+                    self.config_event_watcher,
+                    query,
+                )),
+                'application/json',
+                self.headers.get('Accept-Encoding', ''),
+            )
+
+        # List all events under the date directory and encode them in JSON
+        # format, unless cached for this version of the directory.
+        entry = load_data(
+            date_dir,
+            date,
+            self.headers.get('Accept-Encoding', ''),
+            self.config_event_index,
+            self.config_event_watcher,
+            self.config_result_cache,
+            query,
+        )
+
+        # Check if date directory exists.
+        if entry is None:
+            return ApiResponse(404)
+        body, coding = entry
+        return prepare_body(body, coding, 'application/json')
+
+    def prepare_data_range(
+        self,
+        params: dict[str, list[str]],
+    ) -> ApiResponse:
+
+        # Parse the range of dates and the hours, pages are not supported.
+        date_range = parse_date_range(params)
+        query = parse_event_query(params, '')
+        if (
+            date_range is None or
+            query is None or
+            'after' in params or
+            'limit' in params
+        ):
+            return ApiResponse(400)
+
+        # List the dates within the range.
+        first, last = date_range
+        dates = load_dates(
+            self.config_data_dir,
+            self.config_event_index,
+            self.config_event_watcher,
+        )
+        dates = [date for date in dates if first <= date <= last]
+
+        # List all events of these dates and encode them in JSON format.
+        body, coding = load_range(
+            self.config_data_dir.resolve(),
+            dates,
+            self.headers.get('Accept-Encoding', ''),
+            self.config_scan_executor,
+            self.config_event_index,
+            self.config_event_watcher,
+            self.config_result_cache,
+            query,
+        )
+        return prepare_body(body, coding, 'application/json')
+
+    def prepare_list(self) -> ApiResponse:
+
+        # Parse whether to summarize each date.
+        params = self.query_params()
+        details = params.get('details', ['0'])[0] not in ('0', '')
+
+        # List all valid dates in the data directory and encode them in JSON
+        # format, unless cached for this version of the directory.
+        body, coding = load_list(
+            self.config_data_dir.resolve(),
+            self.headers.get('Accept-Encoding', ''),
+            details,
+            self.config_event_index,
+            self.config_event_watcher,
+            self.config_result_cache,
+            self.config_summary_cache,
+            self.config_scan_executor,
+        )
+        return prepare_body(body, coding, 'application/json')
+
+    def prepare_stats(self) -> ApiResponse:
+
+        # Parse the date.
+        params = self.query_params()
+        date = params.get('date', [None])[0]
+        if date is None:
+            return ApiResponse(400)
+        try:
+            datetime.datetime.strptime(date, '%Y-%m-%d')
+        except ValueError:
+            return ApiResponse(400)
+
+        # Parse the resolution.
+        resolution = params.get('resolution', ['hour'])[0]
+        if resolution not in ('hour', 'minute'):
+            return ApiResponse(400)
+
+        # Resolve the date directory.
+        date_dir = self.config_data_dir.resolve().joinpath(date)
+
+        # Count the events under the date directory and encode them in JSON
+        # format, unless cached for this version of the directory.
+        entry = load_stats(
+            date_dir,
+            date,
+            resolution,
+            self.headers.get('Accept-Encoding', ''),
+            self.config_event_index,
+            self.config_event_watcher,
+            self.config_result_cache,
+        )
+
+        # Check if date directory exists.
+        if entry is None:
+            return ApiResponse(404)
+        body, coding = entry
+        return prepare_body(body, coding, 'application/json')
+
+    def resolve_thumbnail(self, data_suffix: str) -> ThumbnailTarget:
+
+        # Resolve the data directory.
+        data_dir = self.config_data_dir.resolve()
+        data_file = data_dir.joinpath(data_suffix)
+
+        # Reject directory traversals.
+        if not data_file.is_relative_to(data_dir):
+            return ThumbnailTarget(403)
+
+        # Check if the data file exists.
+        if not data_file.is_file():
+            return ThumbnailTarget(404)
+
+        # Parse the width.
+        try:
+            width = parse_thumbnail_width(
+                self.query_params(),
+                self.config_thumbnail_widths,
+            )
+        except ValueError:
+            return ThumbnailTarget(400)
+
+        # For images at full size, serve the source file directly.
+        is_image = data_suffix.endswith(('.jpg', '.jpeg'))
+        if is_image and width is None:
+            response = prepare_file(data_dir, data_suffix, self.headers)
+            return ThumbnailTarget(200, response)
+
+        # Otherwise, only images and videos have thumbnails.
+        if not is_image and not data_suffix.endswith('.mp4'):
+            return ThumbnailTarget(400)
+
+        # Negotiate the most compact format the client accepts, letting
+        # caches know the format depends on the client.
+        thumbnail_dir = self.config_thumbnail_dir.resolve()
+        digest = hashlib.sha256(data_suffix.encode('utf-8')).hexdigest()
+        formats = self.config_thumbnail_formats
+        candidates = negotiate_thumbnail(
+            thumbnail_dir,
+            digest,
+            width,
+            self.headers.get('Accept', ''),
+            formats,
+        )
+        vary = ('Accept',) if formats else ()
+
+        # Serve the first thumbnail that exists, the stat preparing the
+        # response being the only lookup.
+        for thumbnail_file, image_format in candidates:
+            thumbnail_suffix = str(thumbnail_file.relative_to(thumbnail_dir))
+            response = prepare_file(
+                thumbnail_dir,
+                thumbnail_suffix,
+                self.headers,
+                vary=vary,
+            )
+            if response.status != 404:
+                return ThumbnailTarget(200, response)
+
+        # Otherwise, find the file to generate the last one from.
+        source_file = get_thumbnail_source(
+            data_file,
+            thumbnail_dir,
+            digest,
+            width,
+            image_format,
+        )
+        return ThumbnailTarget(
+            200,
+            None,
+            thumbnail_dir,
+            thumbnail_suffix,
+            vary,
+            source_file,
+            thumbnail_file,
+            width,
+        )
+
+
+class Handler(BaseHandler, http.server.BaseHTTPRequestHandler):
+
+    disable_nagle_algorithm = True
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, *args, **kwargs):
+        self._logger = logging.getLogger('[Handler]')
+        self._requests = 0
+        super().__init__(*args, **kwargs)
+
+    def handle_one_request(self):
+
+        # Wait for the next request no longer than the idle timeout, giving
+        # the worker up early to the connections waiting for one.
+        if not self.wait_for_request():
+            self.close_connection = True
+            return
+        self.connection.settimeout(self.config_keep_alive_timeout)
+        self._requests += 1
+        super().handle_one_request()
+
+    def wait_for_request(self) -> bool:
+
+        # A pipelined request may already sit in the read buffer.
+        self.connection.setblocking(False)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.config_keep_alive_timeout)
+
+        # Poll the idle connection, checking in between whether other
+        # connections are waiting for a worker. Unlike select, poll takes
+        # descriptors past 1024.
+        poller = select.poll()
+        poller.register(self.connection, select.POLLIN)
+        deadline = time.monotonic() + self.config_keep_alive_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if poller.poll(min(remaining, 0.2) * 1000):
+                return True
+            if self.server.saturated():
+                return False
+
+    def parse_request(self) -> bool:
+
+        # The idle timeout does not apply while the response is sent.
+        result = super().parse_request()
+        self.connection.settimeout(self.timeout)
+
+        # Request bodies are never read, close the connection rather than
+        # parse one as the next request.
+        if result and (
+            self.headers.get('Content-Length', '0') != '0' or
+            'Transfer-Encoding' in self.headers
+        ):
+            self.close_connection = True
+        return result
+
+    def log_message(self, _format, *_args):
+        pass
+
+    def send_response(self, code: int, message: typing.Optional[str] = None):
+
+        # Close the connection once it has served its share of requests, or
+        # when other connections are waiting for a worker.
+        super().send_response(code, message)
+        if (
+            self.close_connection or
+            self._requests >= self.config_keep_alive_requests or
+            self.server.saturated()
+        ):
+            self.send_header('Connection', 'close')
+
+    def send_error(
+        self,
+        code: int,
+        message: typing.Optional[str] = None,
+        explain: typing.Optional[str] = None,
+    ):
+
+        # Malformed requests and server errors close the connection.
+        if (
+            self.close_connection or
+            self.command not in ('GET', 'HEAD') or
+            code >= 500
+        ):
+            self.close_connection = True
+
+        # Build the error page.
+        try:
+            short_message, long_message = self.responses[code]
+        except KeyError:
+            short_message, long_message = '???', '???'
+        message = message or short_message
+        explain = explain or long_message
+        body = (self.error_message_format % {
+            'code': code,
+            'message': html.escape(message, quote=False),
+            'explain': html.escape(explain, quote=False),
+        }).encode('utf-8', 'replace')
+
+        # Set the response headers, keeping the connection alive unless
+        # closed above.
+        self.send_response(code, message)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Type', self.error_content_type)
+        self.end_headers()
+
+        # Send the error page to the client.
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+
+        # Log the request.
+        path = urllib.parse.urlparse(self.path).path
+        self._logger.info(
+            'Receiving %s %s from %s:%s',
+            self.command,
+            path,
+            *self.client_address,
+        )
+
+        # Match the requested resource.
+        try:
+            if path == '/':
+                file = 'index.html'
+                self.send_file(
+                    self.config_static_dir,
+                    file,
+                    precompressed=True,
+                )
+            elif path.startswith('/api/'):
+                self.send_api(path)
+            elif path.startswith('/data/'):
+                file = path.removeprefix('/data/')
+                self.send_file(self.config_data_dir, file)
+            elif path.startswith('/static/'):
+                file = path.removeprefix('/static/')
+                self.send_file(
+                    self.config_static_dir,
+                    file,
+                    precompressed=True,
+                )
+            elif path.startswith('/thumbnail/'):
+                file = path.removeprefix('/thumbnail/')
+                self.send_thumbnail(file)
+            else:
+                self.send_error(404, 'Not Found')
+
+        # Catch client disconnect.
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+        # An unknown error occured.
+        except Exception as err:
+            self._logger.exception('Unhandled error while processing request')
+            try:
+                self.send_error(500, 'Internal Server Error')
+
+            # Catch client disconnect.
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    def do_HEAD(self):
+
+        # Route like a GET request, the body is omitted when sending.
+        self.do_GET()
+
+    def send_api(self, path: str):
+
+        # Prepare the response.
+        response = self.prepare_api(path)
+        if response.status >= 400:
+            self.send_error(response.status)
+            return
+
+        # Set the response headers.
+        self.send_response(response.status)
+        for name, value in response.headers:
+            self.send_header(name, value)
+        self.end_headers()
+
+        # Send the body, or stream its chunks, to the client.
+        if self.command == 'HEAD':
+            return
+        if response.chunks is None:
+            self.wfile.write(response.body)
+        else:
+            self.send_stream(response.chunks)
+
+    def send_file(
+        self,
+        prefix: pathlib.Path,
+        suffix: str,
+        precompressed: bool = False,
+        vary: tuple[str, ...] = (),
+    ):
+
+        # Prepare the response.
+        response = prepare_file(
+            prefix,
+            suffix,
+            self.headers,
+            precompressed,
+            vary,
+        )
+        self.send_prepared(response)
+
+    def send_prepared(self, response: FileResponse):
+
+        # Send the error page.
+        if response.file is None:
+            self.send_error(response.status)
+            return
+
+        # Serve small files from memory, others straight from disk.
+        source = contextlib.nullcontext()
+        if self.command != 'HEAD' and response.segments:
+            data = None
+            if self.config_file_cache is not None:
+                data = self.config_file_cache.load(
+                    response.file,
+                    response.file_stat,
+                )
+            if data is None:
+                source = open(response.file, 'rb')
+            else:
+                source = contextlib.nullcontext(memoryview(data))
+
+        with source as handle:
+
+            # Set the response headers.
+            self.send_response(response.status)
+            for name, value in response.headers:
+                self.send_header(name, value)
+            self.end_headers()
+
+            # Send the file to the client.
+            if handle is not None:
+                for part, offset, count in response.segments:
+                    if part:
+                        self.wfile.write(part)
+                    self.send_range(handle, offset, count)
+
+    def send_range(
+        self,
+        handle: typing.Union[typing.BinaryIO, memoryview],
+        offset: int,
+        count: int,
+    ):
+
+        # Nothing to send.
+        if count <= 0:
+            return
+
+        # Send cached bytes directly.
+        if isinstance(handle, memoryview):
+            self.wfile.write(handle[offset:offset + count])
+            return
+
+        # Let the kernel copy the byte range straight from the page cache.
+        if hasattr(os, 'sendfile'):
+            self.connection.sendfile(handle, offset, count)
+            return
+
+        # Otherwise, copy the byte range through a large buffer.
+        handle.seek(offset)
+        buffer = memoryview(bytearray(min(count, 1 << 20)))
+        while count > 0:
+            size = handle.readinto(buffer[:min(count, len(buffer))])
+            if not size:
+                break
+            self.wfile.write(buffer[:size])
+            count -= size
+
+    def send_stream(
+        self,
+        make_chunks: typing.Callable[[], typing.Iterable[bytes]],
+    ):
+
+        # Send each chunk to the client as soon as it is encoded.
+        try:
+            for chunk in make_chunks():
+                if chunk:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+
+        # Let the connection handle client disconnect.
+        except (BrokenPipeError, ConnectionResetError):
+            raise
+
+        # The status line is already sent, so leave the stream unterminated
+        # for the client to notice.
+        except Exception:
+            self._logger.exception('Unhandled error while streaming')
+            self.close_connection = True
+            return
+
+        # Send the last chunk.
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_thumbnail(self, data_suffix: str):
+
+        # Resolve the thumbnail, or the image served instead.
+        target = self.resolve_thumbnail(data_suffix)
+        if target.status != 200:
+            self.send_error(target.status)
+            return
+
+        # Send the file found.
+        if target.response is not None:
+            self.send_prepared(target.response)
+            return
+
+        # Otherwise, generate the thumbnail, unless another request already
+        # is, in which case wait for its result.
+        flights = self.config_thumbnail_flights
+        key = target.thumbnail_file.name
+        leader, flight = flights.begin(key)
+        outcome = 'failed'
+        if leader:
+            try:
+                outcome = self.gen_thumbnail(
+                    target.source_file,
+                    target.thumbnail_file,
+                    target.width,
+                )
+            finally:
+                flights.end(key, outcome)
+        elif flight.wait(45):
+            outcome = flight.outcome
+        else:
+            outcome = 'busy'
+
+        # Ask the client to come back when FFmpeg is too busy, or report the
+        # failure.
+        if outcome == 'busy':
+            self.send_busy()
+            return
+        if outcome == 'failed':
+            self.send_error(500)
+            return
+
+        # Send the thumbnail to the client.
+        self.send_file(target.prefix, target.suffix, vary=target.vary)
+
+    def gen_thumbnail(
+        self,
+        source_file: pathlib.Path,
+        thumbnail_file: pathlib.Path,
+        width: typing.Optional[int] = None,
+    ) -> str:
+
+        # Check if the thumbnail appeared in the meantime.
+        if thumbnail_file.is_file():
+            return 'ok'
+
+        # Wait for an FFmpeg slot, giving up when too many requests already
+        # are.
+        limiter = self.config_ffmpeg_limiter
+        if not limiter.acquire(10):
+            self._logger.warning('Too many thumbnails being generated')
+            return 'busy'
+
+        # Generate the thumbnail.
+        try:
+            thumbnail_file.parent.mkdir(parents=True, exist_ok=True)
+            if gen_thumbnail(
+                str(source_file),
+                str(thumbnail_file),
+                width=width,
+            ):
+                return 'ok'
+            return 'failed'
+        finally:
+            limiter.release()
+
+    def send_busy(self):
+
+        # Build the error page.
+        short_message, long_message = self.responses[503]
+        body = (self.error_message_format % {
+            'code': 503,
+            'message': html.escape(short_message, quote=False),
+            'explain': html.escape(long_message, quote=False),
+        }).encode('utf-8', 'replace')
+
+        # Ask the client to come back shortly.
+        self.send_response(503, short_message)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Type', self.error_content_type)
+        self.send_header('Retry-After', '1')
+        self.end_headers()
+
+        # Send the error page.
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+class WorkerPoolHTTPServer(http.server.HTTPServer):
+
+    def __init__(
+        self,
+        server_address: tuple[str, int],
+        handler_class: type,
+        workers: int,
+        queue_size: int,
+        reuse_port: bool = False,
+    ):
+        self._logger = logging.getLogger('[WorkerPoolHTTPServer]')
+        self._queue = queue.Queue(queue_size)
+        self.allow_reuse_port = reuse_port
+        self._idle = 0
+        self._idle_lock = threading.Lock()
+        super().__init__(server_address, handler_class)
+
+        # Start the worker threads.
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(
+                target=self._work,
+                name=f'worker-{i}',
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+
+        # Serve connections until the server closes.
+        while True:
+            with self._idle_lock:
+                self._idle += 1
+            item = self._queue.get()
+            with self._idle_lock:
+                self._idle -= 1
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+
+        # Queue the connection for the next idle worker.
+        try:
+            self._queue.put_nowait((request, client_address))
+            return
+        except queue.Full:
+            pass
+
+        # All workers are busy and the queue is full, turn the client away.
+        self._logger.warning(
+            'Rejecting connection from %s:%s, server saturated',
+            *client_address,
+        )
+        body = b'Service Unavailable\n'
+        response = (
+            b'HTTP/1.1 503 Service Unavailable\r\n'
+            b'Connection: close\r\n'
+            b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n'
+            b'Content-Type: text/plain\r\n'
+            b'Retry-After: 1\r\n'
+            b'\r\n' + body
         )
+        try:
+            request.settimeout(1)
+            request.sendall(response)
+        except OSError:
+            pass
+        self.shutdown_request(request)
 
-    # Catch timeout.
-    except subprocess.TimeoutExpired:
-        logger.error('FFmpeg subprocess timed out')
-        return
+    def saturated(self) -> bool:
 
-    # Check if an error occured.
-    if result.returncode != 0:
-        if result.stderr:
-            for line in result.stderr.splitlines():
-                logger.debug(line.decode('utf-8', errors='replace'))
-        logger.warning(
-            'FFmpeg subprocess exited with non-zero exit code %d',
-            result.returncode,
-        )
+        # More connections are waiting than there are idle workers.
+        return self._queue.qsize() > self._idle
 
+    def server_close(self):
+        super().server_close()
+
+        # Drop the connections still waiting for a worker.
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self.shutdown_request(item[0])
+
+        # Stop the worker threads once they finish their connection.
+        for _ in self._workers:
+            self._queue.put(None)
 
-def get_thumbnail_path(
-    thumbnail_dir: pathlib.Path,
-    digest: str,
-    _offset: int = 0,
-    _limit: int = 100,
-) -> pathlib.Path:
 
-    flat = thumbnail_dir / (digest + '.jpg')
+class AsyncHandler(BaseHandler):
 
-    # If the thumbnail is already stored at this level, use it.
-    if flat.exists():
-        return flat
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        self._logger = logging.getLogger('[AsyncHandler]')
+        self._reader = reader
+        self._writer = writer
+        self._requests = 0
+        self.client_address = writer.get_extra_info('peername')[:2]
+        self.close_connection = True
+        self.command = None
+        self.headers = None
+        self.path = None
+        self.request_version = None
 
-    # If a partition subdirectory for this prefix already exists, recurse into it.
-    prefix = digest[_offset:_offset + 2]
-    subdir = thumbnail_dir / prefix
-    if subdir.is_dir():
-        return get_thumbnail_path(subdir, digest, _offset + 2, _limit)
+    async def handle(self):
 
-    # New thumbnail: store flat if the directory is under the limit, otherwise partition.
-    count = sum(1 for _ in thumbnail_dir.iterdir()) if thumbnail_dir.exists() else 0
-    if count < _limit:
-        return flat
+        # Serve requests until the connection closes.
+        try:
+            while await self.read_request():
+                await self.do_request()
+                await self._writer.drain()
+                if self.close_connection:
+                    break
 
-    subdir.mkdir(parents=True, exist_ok=True)
-    return get_thumbnail_path(subdir, digest, _offset + 2, _limit)
+        # Catch client disconnect.
+        except (BrokenPipeError, ConnectionResetError):
+            pass
 
+        # Close the connection.
+        finally:
+            self._writer.close()
+            with contextlib.suppress(OSError):
+                await self._writer.wait_closed()
 
-class Handler(http.server.BaseHTTPRequestHandler):
+    async def read_request(self) -> bool:
 
-    def __init__(self, *args, **kwargs):
-        event_file_regex = r'^(\d+)-(\d+)-(\d+)-'
-        event_type_regex = r'^(face|smart-motion|tampering)-detection$'
-        self._event_file_pattern = re.compile(event_file_regex)
-        self._event_type_pattern = re.compile(event_type_regex)
-        self._logger = logging.getLogger('[Handler]')
-        super().__init__(*args, **kwargs)
+        # Wait for the next request no longer than the idle timeout.
+        self.command = None
+        try:
+            head = await asyncio.wait_for(
+                self._reader.readuntil(b'\r\n\r\n'),
+                self.config_keep_alive_timeout,
+            )
+        except asyncio.LimitOverrunError:
+            self.close_connection = True
+            self.send_error(431)
+            return False
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return False
+        self._requests += 1
 
-    def log_message(self, _format, *_args):
-        pass
+        # Parse the request line.
+        request_line, _, head = head.partition(b'\r\n')
+        words = request_line.decode('latin-1').split()
+        if len(words) != 3:
+            self.close_connection = True
+            self.send_error(400)
+            return False
+        command, path, version = words
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            self.close_connection = True
+            self.send_error(505)
+            return False
 
-    def do_GET(self):
+        # Parse the headers.
+        try:
+            headers = http.client.parse_headers(io.BytesIO(head))
+        except http.client.HTTPException:
+            self.close_connection = True
+            self.send_error(431)
+            return False
+        self.command = command
+        self.headers = headers
+        self.path = path
+        self.request_version = version
+
+        # Keep HTTP/1.1 connections alive unless the client objects, or sends
+        # a request body that would have to be skipped.
+        connection = headers.get('Connection', '').lower()
+        self.close_connection = (
+            version == 'HTTP/1.0' or
+            'close' in connection or
+            headers.get('Content-Length', '0') != '0' or
+            'Transfer-Encoding' in headers or
+            self._requests >= self.config_keep_alive_requests
+        )
+        return True
+
+    async def do_request(self):
+
+        # Only GET and HEAD requests are supported.
+        if self.command not in ('GET', 'HEAD'):
+            self.close_connection = True
+            self.send_error(501)
+            return
 
         # Log the request.
         path = urllib.parse.urlparse(self.path).path
         self._logger.info(
-            'Receiving GET %s from %s:%s',
+            'Receiving %s %s from %s:%s',
+            self.command,
             path,
             *self.client_address,
         )
@@ -109,189 +3802,394 @@ class Handler(http.server.BaseHTTPRequestHandler):
         try:
             if path == '/':
                 file = 'index.html'
-                self.send_file(self.config_static_dir, file)
-            elif path == '/api/data':
-                self.send_data()
-            elif path == '/api/list':
-                self.send_list()
+                await self.send_file(
+                    self.config_static_dir,
+                    file,
+                    precompressed=True,
+                )
+            elif path.startswith('/api/'):
+                await self.send_api(path)
             elif path.startswith('/data/'):
                 file = path.removeprefix('/data/')
-                self.send_file(self.config_data_dir, file)
+                await self.send_file(self.config_data_dir, file)
             elif path.startswith('/static/'):
                 file = path.removeprefix('/static/')
-                self.send_file(self.config_static_dir, file)
+                await self.send_file(
+                    self.config_static_dir,
+                    file,
+                    precompressed=True,
+                )
             elif path.startswith('/thumbnail/'):
                 file = path.removeprefix('/thumbnail/')
-                self.send_thumbnail(file)
+                await self.send_thumbnail(file)
             else:
-                self.send_error(404, 'Not Found')
+                self.send_error(404)
 
-        # Catch client disconnect.
+        # Let the connection handle client disconnect.
         except (BrokenPipeError, ConnectionResetError):
-            pass
+            raise
 
         # An unknown error occured.
-        except Exception as err:
+        except Exception:
             self._logger.exception('Unhandled error while processing request')
-            try:
-                self.send_error(500, 'Internal Server Error')
+            self.send_error(500)
 
-            # Catch client disconnect.
-            except (BrokenPipeError, ConnectionResetError):
-                pass
+    def send_head(self, code: int, headers: list[tuple[str, str]]):
 
-    def send_data(self):
+        # Build the status line.
+        lines = [
+            f'HTTP/1.1 {code} {http.HTTPStatus(code).phrase}',
+            'Server: {} {}'.format(
+                http.server.BaseHTTPRequestHandler.server_version,
+                http.server.BaseHTTPRequestHandler.sys_version,
+            ),
+            f'Date: {email.utils.formatdate(usegmt=True)}',
+        ]
 
-        # Parse the date.
-        parsed = urllib.parse.urlparse(self.path)
-        params = urllib.parse.parse_qs(parsed.query)
-        date = params.get('date', [None])[0]
-        if date is None:
-            self.send_error(400, 'Bad Request')
-            return
-        try:
-            datetime.datetime.strptime(date, '%Y-%m-%d')
-        except ValueError:
-            self.send_error(400, 'Bad Request')
-            return
+        # Add the response headers.
+        for name, value in headers:
+            lines.append(f'{name}: {value}')
+        if self.close_connection:
+            lines.append('Connection: close')
 
-        # Resolve the date directory.
-        date_dir = self.config_data_dir.resolve().joinpath(date)
+        # Queue the head for the client.
+        head = '\r\n'.join(lines) + '\r\n\r\n'
+        self._writer.write(head.encode('latin-1', 'strict'))
 
-        # Check if date directory exists.
-        if not date_dir.exists() or not date_dir.is_dir():
-            self.send_error(404, 'Not Found')
-            return
+    def send_error(self, code: int):
 
-        # List all events under the date directory.
-        events = []
-        for date_dir_item in date_dir.iterdir():
-            event_type = date_dir_item.name
-            if self._event_type_pattern.fullmatch(event_type):
-                event_dir = date_dir.joinpath(event_type)
-                for event_dir_item in event_dir.iterdir():
-                    event_file = event_dir_item.name
-                    if 'deadbeef' in event_file.lower():
-                        continue
-                    match = self._event_file_pattern.match(event_file)
-                    if match:
-                        hh, mm, ss = map(int, match.groups())
-                        events.append({
-                            'event_type': event_type,
-                            'file': f'{date}/{event_type}/{event_file}',
-                            'timestamp': f'{date}T{hh}:{mm}:{ss}Z'
-                        })
+        # Server errors close the connection.
+        if code >= 500:
+            self.close_connection = True
 
-        # Sort the events chronologically.
-        events.sort(key=lambda event: event['timestamp'])
+        # Build the error page.
+        status = http.HTTPStatus(code)
+        body = (http.server.DEFAULT_ERROR_MESSAGE % {
+            'code': code,
+            'message': html.escape(status.phrase, quote=False),
+            'explain': html.escape(status.description, quote=False),
+        }).encode('utf-8', 'replace')
 
-        # Encode the events in JSON format.
-        body = json.dumps(events).encode('utf-8')
+        # Queue the error page for the client.
+        self.send_head(code, [
+            ('Content-Length', str(len(body))),
+            ('Content-Type', http.server.DEFAULT_ERROR_CONTENT_TYPE),
+        ])
+        if self.command != 'HEAD':
+            self._writer.write(body)
 
-        # Set the response headers.
-        self.send_response(200)
-        self.send_header('Content-Length', str(len(body)))
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
+    async def send_api(self, path: str):
+
+        # Prepare the response off the event loop.
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, self.prepare_api, path)
+        if response.status >= 400:
+            self.send_error(response.status)
+            return
 
-        # Send the JSON-encoded events to the client.
-        self.wfile.write(body)
+        # Queue the body for the client, or stream its chunks.
+        self.send_head(response.status, response.headers)
+        if self.command == 'HEAD':
+            return
+        if response.chunks is None:
+            self._writer.write(response.body)
+        else:
+            await self.send_stream(response.chunks)
+
+    async def send_file(
+        self,
+        prefix: pathlib.Path,
+        suffix: str,
+        precompressed: bool = False,
+        vary: tuple[str, ...] = (),
+    ):
 
-    def send_file(self, prefix: pathlib.Path, suffix: str):
+        # Prepare the response off the event loop.
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            None,
+            prepare_file,
+            prefix,
+            suffix,
+            self.headers,
+            precompressed,
+            vary,
+        )
+        await self.send_prepared(response)
 
-        # Resolve the file.
-        path = prefix.resolve()
-        file = path.joinpath(suffix)
+    async def send_prepared(self, response: FileResponse):
 
-        # Reject directory traversals.
-        if not file.is_relative_to(path):
-            self.send_error(403, 'Forbidden')
+        # Send the error page.
+        if response.file is None:
+            self.send_error(response.status)
             return
 
-        # Check if file exists.
-        if not file.exists() or not file.is_file():
-            self.send_error(404, 'Not Found')
+        # Serve small files from memory.
+        loop = asyncio.get_running_loop()
+        data = None
+        if (
+            self.command != 'HEAD' and
+            response.segments and
+            self.config_file_cache is not None
+        ):
+            data = await loop.run_in_executor(
+                None,
+                self.config_file_cache.load,
+                response.file,
+                response.file_stat,
+            )
+        if data is not None:
+            self.send_head(response.status, response.headers)
+            for part, offset, count in response.segments:
+                self._writer.write(part)
+                self._writer.write(memoryview(data)[offset:offset + count])
             return
 
-        # Guess the content type.
-        content_type, _ = mimetypes.guess_type(file)
-        content_type = content_type or 'application/octet-stream'
+        # Nothing else to send.
+        if self.command == 'HEAD' or not response.segments:
+            self.send_head(response.status, response.headers)
+            return
 
-        # Set the response headers.
-        self.send_response(200)
-        self.send_header('Cache-Control', 'private, max-age=3600')
-        self.send_header('Content-Length', str(file.stat().st_size))
-        self.send_header('Content-Type', content_type)
-        self.end_headers()
+        # Serve other files straight from disk.
+        handle = await loop.run_in_executor(None, open, response.file, 'rb')
+        try:
+            self.send_head(response.status, response.headers)
+            for part, offset, count in response.segments:
+                if part:
+                    self._writer.write(part)
+                if count > 0:
+                    await loop.sendfile(
+                        self._writer.transport,
+                        handle,
+                        offset,
+                        count,
+                    )
+        finally:
+            handle.close()
 
-        # Send the file to the client.
-        with open(file, 'rb') as handle:
-            for chunk in iter(lambda: handle.read(8192), b''):
-                self.wfile.write(chunk)
+    async def send_stream(
+        self,
+        make_chunks: typing.Callable[[], typing.Iterable[bytes]],
+    ):
 
-    def send_list(self):
+        # Produce the chunks in a single worker thread, since the event index
+        # connections belong to the thread that opened them, handing each one
+        # to the event loop and waiting until it is written.
+        loop = asyncio.get_running_loop()
 
-        # List all valid dates in the data directory.
-        dates = []
-        for item in self.config_data_dir.iterdir():
-            date = item.name
-            try:
-                datetime.datetime.strptime(date, '%Y-%m-%d')
-                dates.append(date)
-            except ValueError:
-                continue
+        def produce():
+            for chunk in make_chunks():
+                if chunk:
+                    future = asyncio.run_coroutine_threadsafe(
+                        self.write_chunk(chunk),
+                        loop,
+                    )
+                    future.result()
 
-        # Sort the dates chronologically.
-        dates.sort()
+        # Send the chunks to the client.
+        try:
+            await loop.run_in_executor(None, produce)
 
-        # Encode the dates in JSON format.
-        body = json.dumps(dates).encode('utf-8')
+        # Let the connection handle client disconnect.
+        except (BrokenPipeError, ConnectionResetError):
+            raise
 
-        # Set the response headers.
-        self.send_response(200)
-        self.send_header('Content-Length', str(len(body)))
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
+        # The status line is already sent, so leave the stream unterminated
+        # for the client to notice.
+        except Exception:
+            self._logger.exception('Unhandled error while streaming')
+            self.close_connection = True
+            return
 
-        # Send the JSON-encoded dates to the client.
-        self.wfile.write(body)
+        # Send the last chunk.
+        self._writer.write(b'0\r\n\r\n')
 
-    def send_thumbnail(self, data_suffix: str):
+    async def write_chunk(self, chunk: bytes):
 
-        # Resolve the data directory.
-        data_dir = self.config_data_dir.resolve()
-        data_file = data_dir.joinpath(data_suffix)
+        # Send the chunk, waiting for the client to keep up.
+        self._writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        await self._writer.drain()
 
-        # Reject directory traversals.
-        if not data_file.is_relative_to(data_dir):
-            self.send_error(403, 'Forbidden')
+    async def send_thumbnail(self, data_suffix: str):
+
+        # Resolve the thumbnail, or the image served instead, off the event
+        # loop.
+        loop = asyncio.get_running_loop()
+        target = await loop.run_in_executor(
+            None,
+            self.resolve_thumbnail,
+            data_suffix,
+        )
+        if target.status != 200:
+            self.send_error(target.status)
             return
 
-        # Check if the data file exists.
-        if not data_file.exists() or not data_file.is_file():
-            self.send_error(404, 'Not Found')
+        # Send the file found.
+        if target.response is not None:
+            await self.send_prepared(target.response)
             return
 
-        # For images, serve the source file directly.
-        if data_suffix.endswith('.jpg') or data_suffix.endswith('.jpeg'):
-            self.send_file(data_dir, data_suffix)
+        # Otherwise, generate the thumbnail, unless another request already
+        # is, in which case wait for its result on the event loop.
+        flights = self.config_thumbnail_flights
+        key = target.thumbnail_file.name
+        leader, flight = flights.begin(key)
+        outcome = 'failed'
+        if leader:
+            try:
+                outcome = await self.gen_thumbnail(
+                    target.source_file,
+                    target.thumbnail_file,
+                    target.width,
+                )
+            finally:
+                flights.end(key, outcome)
+        elif await flight.wait_async(45):
+            outcome = flight.outcome
+        else:
+            outcome = 'busy'
+
+        # Ask the client to come back when FFmpeg is too busy, or report the
+        # failure.
+        if outcome == 'busy':
+            self.send_busy()
+            return
+        if outcome == 'failed':
+            self.send_error(500)
             return
 
-        # For videos, generate and serve a thumbnail.
-        if data_suffix.endswith('.mp4'):
-            thumbnail_dir = self.config_thumbnail_dir.resolve()
-            digest = hashlib.sha256(data_suffix.encode('utf-8')).hexdigest()
-            thumbnail_file = get_thumbnail_path(thumbnail_dir, digest)
+        # Send the thumbnail to the client.
+        await self.send_file(target.prefix, target.suffix, vary=target.vary)
 
-            if not thumbnail_file.exists() or not thumbnail_file.is_file():
-                thumbnail_file.parent.mkdir(parents=True, exist_ok=True)
-                gen_thumbnail(str(data_file), str(thumbnail_file))
+    async def gen_thumbnail(
+        self,
+        source_file: pathlib.Path,
+        thumbnail_file: pathlib.Path,
+        width: typing.Optional[int] = None,
+    ) -> str:
 
-            thumbnail_suffix = str(thumbnail_file.relative_to(thumbnail_dir))
-            self.send_file(thumbnail_dir, thumbnail_suffix)
-            return
+        # Check if the thumbnail appeared in the meantime.
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, thumbnail_file.is_file):
+            return 'ok'
+
+        # Wait for an FFmpeg slot on the event loop, giving up when too many
+        # requests already are.
+        limiter = self.config_ffmpeg_limiter
+        if not await limiter.acquire_async(10):
+            self._logger.warning('Too many thumbnails being generated')
+            return 'busy'
+
+        # Generate the thumbnail.
+        try:
+            await loop.run_in_executor(
+                None,
+                functools.partial(
+                    thumbnail_file.parent.mkdir,
+                    parents=True,
+                    exist_ok=True,
+                ),
+            )
+            if await gen_thumbnail_async(
+                str(source_file),
+                str(thumbnail_file),
+                width,
+            ):
+                return 'ok'
+            return 'failed'
+        finally:
+            limiter.release()
+
+    def send_busy(self):
+
+        # Build the error page.
+        status = http.HTTPStatus.SERVICE_UNAVAILABLE
+        body = (http.server.DEFAULT_ERROR_MESSAGE % {
+            'code': status.value,
+            'message': html.escape(status.phrase, quote=False),
+            'explain': html.escape(status.description, quote=False),
+        }).encode('utf-8', 'replace')
+
+        # Queue the error page for the client, asking it to come back
+        # shortly.
+        self.send_head(status.value, [
+            ('Content-Length', str(len(body))),
+            ('Content-Type', http.server.DEFAULT_ERROR_CONTENT_TYPE),
+            ('Retry-After', '1'),
+        ])
+        if self.command != 'HEAD':
+            self._writer.write(body)
+
+
+class AsyncHTTPServer:
+
+    def __init__(
+        self,
+        server_address: tuple[str, int],
+        handler_class: type,
+        reuse_port: bool = False,
+    ):
+        self._handler_class = handler_class
+        self._connections = set()
+        self._loop = asyncio.new_event_loop()
+        self._stop = asyncio.Event()
+        self._is_shut_down = threading.Event()
+        self.socket = socket.create_server(
+            server_address,
+            backlog=1024,
+            reuse_port=reuse_port,
+        )
+
+    async def _handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+
+        # Track the connection so it can be cancelled on shutdown.
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            sock = writer.get_extra_info('socket')
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            await self._handler_class(reader, writer).handle()
+
+        # Connections cancelled on shutdown end quietly.
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._connections.discard(task)
+
+    async def _serve(self):
 
-        self.send_error(400, 'Bad Request')
+        # Accept connections until asked to stop.
+        server = await asyncio.start_server(self._handle, sock=self.socket)
+        async with server:
+            await self._stop.wait()
+
+        # Cancel the open connections.
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+
+    def serve_forever(self):
+
+        # Run the event loop until shutdown.
+        self._is_shut_down.clear()
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._is_shut_down.set()
+
+    def shutdown(self):
+
+        # Stop serving and wait for the event loop to finish.
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        self.socket.close()
+        self._loop.close()
 
 
 # Entry point.
@@ -299,12 +4197,64 @@ def main():
 
     # Parse command-line arguments.
     parser = argparse.ArgumentParser(description='Sovereign Data Explorer')
+    parser.add_argument(
+        'command',
+        choices=['index', 'migrate', 'serve'],
+        default='serve',
+        help='Build the event index, move the thumbnails to the current '
+        'layout, or run the web server (default: serve)',
+        nargs='?',
+        type=str,
+    )
     parser.add_argument(
         '--data-dir',
         default='data',
         help='Data directory (default: data)',
         type=pathlib.Path,
     )
+    parser.add_argument(
+        '--engine',
+        choices=['asyncio', 'threading'],
+        default='threading',
+        help='Serving engine (default: threading)',
+        type=str,
+    )
+    parser.add_argument(
+        '--ffmpeg-queue-size',
+        default=16,
+        help='Thumbnails waiting for an FFmpeg slot (default: 16)',
+        type=int,
+    )
+    parser.add_argument(
+        '--file-cache-max-kb',
+        default=1024,
+        help='Largest file kept in the file cache (default: 1024)',
+        type=int,
+    )
+    parser.add_argument(
+        '--file-cache-mb',
+        default=64,
+        help='Memory budget of the file cache, 0 to disable (default: 64)',
+        type=int,
+    )
+    parser.add_argument(
+        '--index-file',
+        default=None,
+        help='SQLite event index backing the API (default: none)',
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        '--keep-alive-requests',
+        default=1000,
+        help='Requests served per connection (default: 1000)',
+        type=int,
+    )
+    parser.add_argument(
+        '--keep-alive-timeout',
+        default=15.0,
+        help='Seconds an idle connection is kept open (default: 15)',
+        type=float,
+    )
     parser.add_argument(
         '--listen-ip',
         default='0.0.0.0',
@@ -323,18 +4273,88 @@ def main():
         help='Granularity of log messages (default: INFO)',
         type=valid_log_level,
     )
+    parser.add_argument(
+        '--max-ffmpeg',
+        default=4,
+        help='FFmpeg processes running at once (default: 4)',
+        type=int,
+    )
+    parser.add_argument(
+        '--processes',
+        default=1,
+        help='Worker processes sharing the listen port (default: 1)',
+        type=int,
+    )
+    parser.add_argument(
+        '--queue-size',
+        default=256,
+        help='Connections waiting for a worker (default: 256)',
+        type=int,
+    )
+    parser.add_argument(
+        '--result-cache-mb',
+        default=16,
+        help='Memory budget of the API result cache, 0 to disable '
+        '(default: 16)',
+        type=int,
+    )
+    parser.add_argument(
+        '--scan-threads',
+        default=8,
+        help='Threads scanning the days of a date range (default: 8)',
+        type=int,
+    )
     parser.add_argument(
         '--static-dir',
         default='static',
         help='Static assets directory (default: static)',
         type=pathlib.Path,
     )
+    parser.add_argument(
+        '--thumbnail-days',
+        default=2,
+        help='Most recent dates whose thumbnails are generated ahead of '
+        'time (default: 2)',
+        type=int,
+    )
     parser.add_argument(
         '--thumbnail-dir',
         default='thumbnail',
         help='Thumbnail directory (default: thumbnail)',
         type=pathlib.Path,
     )
+    parser.add_argument(
+        '--thumbnail-pregenerate-widths',
+        help='Comma separated thumbnail widths generated ahead of time, '
+        'among --thumbnail-widths (default: 320, if among them)',
+        type=valid_widths,
+    )
+    parser.add_argument(
+        '--thumbnail-widths',
+        default='160,320,640',
+        help='Comma separated widths thumbnails can be scaled down to '
+        '(default: 160,320,640)',
+        type=valid_widths,
+    )
+    parser.add_argument(
+        '--thumbnail-workers',
+        default=2,
+        help='Threads generating thumbnails ahead of time, 0 to disable '
+        '(default: 2)',
+        type=int,
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Keep the events in memory, following changes to the data '
+        'directory (default: off)',
+    )
+    parser.add_argument(
+        '--workers',
+        default=64,
+        help='Worker threads serving connections (default: 64)',
+        type=int,
+    )
     args = parser.parse_args()
 
     # Define the logger.
@@ -345,10 +4365,132 @@ def main():
     )
     logger = logging.getLogger('[main]')
 
+    # Build the event index.
+    if args.command == 'index':
+        if args.index_file is None:
+            parser.error('the index command requires --index-file')
+        event_index = EventIndex(args.index_file, args.data_dir)
+        count = event_index.build()
+        logger.info('Indexed %d events into %s', count, args.index_file)
+        return
+
+    # Move the thumbnails to the current layout.
+    if args.command == 'migrate':
+        count = migrate_thumbnails(args.thumbnail_dir.resolve())
+        logger.info('Moved %d thumbnails in %s', count, args.thumbnail_dir)
+        return
+
+    # Only pre-generate the widths that can be served, by default the one
+    # the grid requests.
+    if args.thumbnail_pregenerate_widths is None:
+        args.thumbnail_pregenerate_widths = args.thumbnail_widths & {320}
+    elif not args.thumbnail_pregenerate_widths <= args.thumbnail_widths:
+        parser.error(
+            '--thumbnail-pregenerate-widths must be among --thumbnail-widths',
+        )
+
+    # Leave worker threads free for other requests, since every thumbnail
+    # waiting for or running FFmpeg holds one.
+    if args.engine == 'threading':
+        if args.ffmpeg_queue_size + args.max_ffmpeg >= args.workers:
+            parser.error(
+                '--ffmpeg-queue-size plus --max-ffmpeg must be below '
+                '--workers',
+            )
+
+    # Precompress the static assets.
+    count = precompress(args.static_dir)
+    logger.info('Precompressed %d static assets', count)
+
+    # Run the web server, in several processes if requested.
+    if args.processes > 1:
+        supervise(args)
+    else:
+        serve(args)
+
+
+# Run the web server in this process.
+def serve(
+    args: argparse.Namespace,
+    reuse_port: bool = False,
+    slot: int = 0,
+    ffmpeg_slot_dir: typing.Optional[pathlib.Path] = None,
+):
+
+    logger = logging.getLogger('[serve]')
+
     # Define the web server and thread.
     server = None
     thread = None
 
+    # Define the event index.
+    event_index = None
+    if args.index_file is not None:
+        event_index = EventIndex(args.index_file, args.data_dir)
+
+    # Define the event watcher.
+    event_watcher = None
+    if args.watch:
+        event_watcher = EventWatcher(args.data_dir)
+        event_watcher.start()
+
+    # Define the registry of thumbnails being generated.
+    thumbnail_flights = SingleFlight()
+
+    # Find the compact thumbnail formats FFmpeg can write.
+    thumbnail_formats = list_thumbnail_formats()
+    logger.info(
+        'Serving thumbnails as %s',
+        ', '.join(thumbnail_formats + ('jpg',)),
+    )
+
+    # Define the FFmpeg limiter, sharing the budget with the other
+    # processes, if any.
+    ffmpeg_limiter = ProcessLimiter(
+        args.max_ffmpeg,
+        args.ffmpeg_queue_size,
+        ffmpeg_slot_dir,
+    )
+
+    # Define the thumbnail pre-generator, in the first process only.
+    pregenerator = None
+    if slot == 0 and args.thumbnail_workers > 0:
+        pregenerator = ThumbnailPregenerator(
+            args.data_dir.resolve(),
+            args.thumbnail_dir.resolve(),
+            args.thumbnail_workers,
+            args.thumbnail_days,
+            event_index,
+            event_watcher,
+            thumbnail_flights,
+            ffmpeg_limiter,
+            args.thumbnail_pregenerate_widths,
+            thumbnail_formats,
+        )
+        pregenerator.start()
+
+    # Define the file cache.
+    file_cache = None
+    if args.file_cache_mb > 0:
+        file_cache = FileCache(
+            args.file_cache_mb * 1024 * 1024,
+            args.file_cache_max_kb * 1024,
+        )
+
+    # Define the result cache.
+    result_cache = None
+    if args.result_cache_mb > 0:
+        result_cache = ResultCache(args.result_cache_mb * 1024 * 1024)
+
+    # Define the summary cache.
+    summary_cache = SummaryCache()
+
+    # Define the thread pool scanning date ranges.
+    scan_executor = concurrent.futures.ThreadPoolExecutor(
+        args.scan_threads,
+        thread_name_prefix='scan',
+    )
+
     # Define the shutdown event.
     shutdown_event = threading.Event()
 
@@ -364,6 +4506,38 @@ def main():
             server.shutdown()
             server.server_close()
 
+        # Stop the thumbnail pre-generator, the event watcher and the
+        # scanning threads.
+        if pregenerator is not None:
+            pregenerator.stop()
+        if event_watcher is not None:
+            event_watcher.stop()
+        scan_executor.shutdown()
+
+        # Report the file cache efficiency.
+        if file_cache is not None:
+            logger.info(
+                'File cache served %(hits)d hits and %(misses)d misses, '
+                'holding %(entries)d files in %(bytes)d bytes',
+                file_cache.stats(),
+            )
+
+        # Report the FFmpeg backpressure.
+        logger.info(
+            'FFmpeg limiter started %(started)d processes after waiting '
+            '%(wait_time).1f seconds with up to %(peak_waiting)d queued, '
+            'turning away %(rejected)d and timing out %(timeouts)d',
+            ffmpeg_limiter.stats(),
+        )
+
+        # Report the result cache efficiency.
+        if result_cache is not None:
+            logger.info(
+                'Result cache served %(hits)d hits and %(misses)d misses, '
+                'holding %(entries)d results in %(bytes)d bytes',
+                result_cache.stats(),
+            )
+
         # Graceful shutdown complete.
         logger.info('Graceful shutdown complete')
         shutdown_event.set()
@@ -373,14 +4547,37 @@ def main():
     signal.signal(signal.SIGTERM, shutdown_handler)
 
     # Configure the request handler.
-    class HandlerWithConfig(Handler):
+    handler_class = AsyncHandler if args.engine == 'asyncio' else Handler
+
+    class HandlerWithConfig(handler_class):
         config_data_dir = args.data_dir
+        config_event_index = event_index
+        config_event_watcher = event_watcher
+        config_ffmpeg_limiter = ffmpeg_limiter
+        config_file_cache = file_cache
+        config_keep_alive_requests = args.keep_alive_requests
+        config_keep_alive_timeout = args.keep_alive_timeout
+        config_result_cache = result_cache
+        config_scan_executor = scan_executor
         config_static_dir = args.static_dir
+        config_summary_cache = summary_cache
         config_thumbnail_dir = args.thumbnail_dir
+        config_thumbnail_flights = thumbnail_flights
+        config_thumbnail_formats = thumbnail_formats
+        config_thumbnail_widths = args.thumbnail_widths
 
     # Start the web server.
     socket_addr = (args.listen_ip, args.listen_port)
-    server = http.server.ThreadingHTTPServer(socket_addr, HandlerWithConfig)
+    if args.engine == 'asyncio':
+        server = AsyncHTTPServer(socket_addr, HandlerWithConfig, reuse_port)
+    else:
+        server = WorkerPoolHTTPServer(
+            socket_addr,
+            HandlerWithConfig,
+            args.workers,
+            args.queue_size,
+            reuse_port,
+        )
     thread = threading.Thread(target=server.serve_forever, daemon=True)
     thread.start()
     logger.info('Listening on port %d', args.listen_port)
@@ -390,6 +4587,101 @@ def main():
     thread.join()
 
 
+# Run the web server in several worker processes.
+def supervise(args: argparse.Namespace):
+
+    logger = logging.getLogger('[supervise]')
+
+    # Define the worker processes, by process ID, and their start times and
+    # slots.
+    workers = {}
+    stopping = False
+
+    # Define the slot files through which the worker processes share the
+    # FFmpeg budget.
+    ffmpeg_slot_dir = pathlib.Path(tempfile.mkdtemp(prefix='ffmpeg-slots-'))
+
+    # Define the worker spawner.
+    def spawn(slot: int):
+
+        # Fork a worker process, binding its own socket to the shared port.
+        # Only the first slot generates thumbnails ahead of time.
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 1
+            try:
+                serve(
+                    args,
+                    reuse_port=True,
+                    slot=slot,
+                    ffmpeg_slot_dir=ffmpeg_slot_dir,
+                )
+                code = 0
+            except Exception:
+                logger.exception('Worker process %d failed', os.getpid())
+            finally:
+                logging.shutdown()
+                os._exit(code)
+
+        # Track the worker process.
+        workers[pid] = (time.monotonic(), slot)
+        logger.info('Started worker process %d', pid)
+
+    # Define the shutdown handler.
+    def shutdown_handler(sig, frame):
+        nonlocal stopping
+
+        # What kind of signal did we receive?
+        name = signal.Signals(sig).name
+        logger.info('Received signal %s', name)
+
+        # Forward the shutdown to the worker processes.
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # Register the shutdown handler.
+    signal.signal(signal.SIGINT, shutdown_handler)
+    signal.signal(signal.SIGTERM, shutdown_handler)
+
+    # Start the worker processes.
+    for slot in range(args.processes):
+        spawn(slot)
+
+    # Restart crashed worker processes until shutdown.
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker = workers.pop(pid, None)
+        if worker is None or stopping:
+            continue
+        started, slot = worker
+        logger.warning(
+            'Worker process %d exited with code %d, restarting',
+            pid,
+            os.waitstatus_to_exitcode(status),
+        )
+
+        # Back off if the worker process dies right after starting.
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        if not stopping:
+            spawn(slot)
+
+    # Remove the slot files.
+    shutil.rmtree(ffmpeg_slot_dir, ignore_errors=True)
+
+    # Graceful shutdown complete.
+    logger.info('Graceful shutdown complete')
+
+
 # Check if the given string is a valid log level.
 def valid_log_level(level: str) -> int:
     try:
@@ -398,6 +4690,16 @@ def valid_log_level(level: str) -> int:
         raise argparse.ArgumentTypeError(f'Invalid log level: {level}')
 
 
+def valid_widths(widths: str) -> frozenset[int]:
+    try:
+        values = frozenset(int(width) for width in widths.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid widths: {widths}')
+    if any(value <= 0 for value in values):
+        raise argparse.ArgumentTypeError(f'Invalid widths: {widths}')
+    return values
+
+
 # Start.
 if __name__ == '__main__':
     main()
\ No newline at end of file